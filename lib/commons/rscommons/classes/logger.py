@@ -30,8 +30,13 @@ class _LoggerSingleton:
             self.initialized = False
             self.verbose = False
             self.logpath = None
+            self.handler = None
 
         def setup(self, logPath=None, verbose=False):
+            # Repeat setups in the same process (batched runs) reuse the existing handler
+            if self.initialized and logPath == self.logpath and verbose == self.verbose:
+                return
+
             self.initialized = True
             self.verbose = verbose
 
@@ -44,6 +49,14 @@ class _LoggerSingleton:
             osgeoLogger = logging.getLogger("osgeo")
             osgeoLogger.setLevel(logging.WARNING)
 
+            # Swap out any handler from a previous setup so records don't go to both files
+            if self.handler is not None:
+                self.logger.removeHandler(self.handler)
+                osgeoLogger.removeHandler(self.handler)
+                self.handler.close()
+                self.handler = None
+            self.logpath = None
+
             if logPath:
                 self.logpath = logPath
                 if not os.path.exists(os.path.dirname(logPath)):
@@ -51,7 +64,8 @@ class _LoggerSingleton:
                 if not os.path.isdir(os.path.dirname(logPath)):
                     os.makedirs(os.path.dirname(logPath))
 
-                self.handler = logging.FileHandler(logPath, mode='w')
+                # delay=True: the file isn't opened until the first record is written
+                self.handler = logging.FileHandler(logPath, mode='w', delay=True)
                 self.handler.setLevel(loglevel)
                 # self.handler.
                 self.handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s [%(curmethod)-15s] %(message)s'))
@@ -443,7 +443,19 @@ class RSProject:
         nod_dataset = self.add_dataset(parent_node, file_path, rs_lyr, 'Vector', replace)
         return nod_dataset, file_path
 
-    def add_project_raster(self, parent_node, rs_lyr, copy_path=None, replace=False):
+    def add_project_raster(self, parent_node, rs_lyr, copy_path=None, replace=False, inplace=False):
+        """Add a raster to the project, optionally copying it in from copy_path
+
+        Args:
+            parent_node: project node to add the raster under
+            rs_lyr (RSLayer): layer definition
+            copy_path (str, optional): raster to copy into the project. Defaults to None.
+            replace (bool, optional): replace an existing dataset node. Defaults to False.
+            inplace (bool, optional): hard link a GeoTIFF copy_path into the project instead of rewriting it,
+                falling back to a copy for other formats or when the link can't be made (e.g. across filesystems).
+                The linked file shares its data with copy_path, so anything that later opens the project copy
+                for update (statistics, overviews) also changes the original. Defaults to False.
+        """
         log = Logger('add_project_raster')
 
         file_path = os.path.join(os.path.dirname(self.xml_path), rs_lyr.rel_path)
@@ -467,9 +479,26 @@ class RSProject:
             if not os.path.exists(copy_path) or not rs_lyr:
                 log.error('Could not find mandatory input "{}" raster at path "{}"'.format(rs_lyr.name, copy_path))
 
-            # Rasterio copies datasets efficiently
-            rasterio.shutil.copy(copy_path, file_path, compress='LZW', predictor=2)
-            log.info('Raster Copied {} to {}'.format(copy_path, file_path))
+            linked = False
+            if inplace is True:
+                # Only GeoTIFFs are safe to link. Other formats (e.g. a VRT with relative source paths)
+                # would end up under a .tif name or break once they live in another folder
+                with rasterio.open(copy_path) as src:
+                    link_driver = src.driver
+                if link_driver != 'GTiff':
+                    log.debug('Not linking {} raster, copying instead'.format(link_driver))
+                else:
+                    try:
+                        os.link(copy_path, file_path)
+                        linked = True
+                        log.info('Raster Linked {} to {}'.format(copy_path, file_path))
+                    except OSError as e:
+                        log.debug('Could not link raster, copying instead: {}'.format(e))
+
+            if linked is False:
+                # Rasterio copies datasets efficiently
+                rasterio.shutil.copy(copy_path, file_path, compress='LZW', predictor=2)
+                log.info('Raster Copied {} to {}'.format(copy_path, file_path))
 
         nod_dataset = self.add_dataset(parent_node, file_path, rs_lyr, 'Raster', replace)
         return nod_dataset, file_path
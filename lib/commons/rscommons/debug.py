@@ -151,9 +151,10 @@ class MemoryMonitor:
         fig.savefig(imgpath, format='png', dpi=300)
 
 
-def ThreadRun(callback, memlogfile: str, *args, **kwargs):
+def ThreadRun(callback, memlogfile: str, *args, sample_interval: float = 1, **kwargs):
+    """Run callback while sampling process memory and CPU every sample_interval seconds"""
     log = Logger('Debug')
-    memmon = MemoryMonitor(memlogfile, 1)
+    memmon = MemoryMonitor(memlogfile, sample_interval)
     result = None
     max_obj = None
     try:
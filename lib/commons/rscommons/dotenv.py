@@ -5,6 +5,9 @@ import os
 import argparse
 from pathlib import Path
 
+# Parsed .env files keyed on (absolute path, mtime) so repeat calls in one process skip the re-read
+_DOTENV_CACHE = {}
+
 
 def parse_dotenv(dotenv_path):
     """Given a path to a dotenv file, return that file as a dictionary
@@ -15,10 +18,26 @@ def parse_dotenv(dotenv_path):
     Returns:
         [type]: [description]
     """
-    results = {}
     # We fall back gracefully if there's no file there
     if not os.path.exists(dotenv_path):
-        return results
+        return {}
+
+    cache_key = (os.path.abspath(dotenv_path), os.stat(dotenv_path).st_mtime_ns)
+    if cache_key not in _DOTENV_CACHE:
+        _DOTENV_CACHE[cache_key] = _read_dotenv(dotenv_path)
+    return dict(_DOTENV_CACHE[cache_key])
+
+
+def _read_dotenv(dotenv_path):
+    """Read and parse a dotenv file without caching
+
+    Args:
+        dotenv_path (str): path to the dotenv file
+
+    Returns:
+        dict: key: value pairs from the file
+    """
+    results = {}
     with open(dotenv_path) as f:
         for line in f:
             line = line.strip()
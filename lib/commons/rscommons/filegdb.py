@@ -5,8 +5,7 @@ import sqlite3
 import argparse
 from shapely.ops import transform
 from functools import reduce
-import json
-from shapely.geometry import mapping, shape
+from shapely.geometry import shape
 from rscommons.util import safe_makedirs
 from rscommons import ProgressBar, Logger
 from rscommons.shapefile import create_field, get_transform_from_epsg
@@ -29,7 +28,7 @@ def export_feature_class(filegdb, featureclass, output_dir, output_epsg, retaine
 
     if spatial_filter:
         log.info('Export spatial filter area: {}'.format(spatial_filter.area))
-        in_layer.SetSpatialFilter(ogr.CreateGeometryFromJson(json.dumps(mapping(spatial_filter))))
+        in_layer.SetSpatialFilter(ogr.CreateGeometryFromWkb(spatial_filter.wkb))
 
     safe_makedirs(output_dir)
 
@@ -143,9 +142,8 @@ def export_table(filegdb, tablename, db_path, retained_fields, attribute_filter,
     for in_feature in in_layer:
         counter += 1
         progbar.update(counter)
-        obj = json.loads(in_feature.ExportToJson())
         sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(tablename, ','.join([name for name, dtype, idx in header]), ','.join(['?' for val in header]))
-        curs.execute(sql, [obj['properties'][name] for name, dtype, idx in header])
+        curs.execute(sql, [in_feature.GetField(idx) for name, dtype, idx in header])
 
     progbar.finish()
 
@@ -12,6 +12,7 @@ import os
 import time
 from typing import List
 import subprocess
+import threading
 from osgeo import gdal
 from rscommons.util import pretty_duration
 from rscommons import Logger, ProgressBar, VectorBase
@@ -81,7 +82,7 @@ def create_hand_raster(dem: str, rasterized_drainage: str, working_dir: str, out
     return out_hand
 
 
-def hand_rasterize(in_lyr_path: str, template_dem_path: str, out_raster_path: str):
+def hand_rasterize(in_lyr_path: str, template_dem_path: str, out_raster_path: str, creation_options: List[str] = None):
     # log = Logger('hand_rasterize')
     ds_path, lyr_path = VectorBase.path_sorter(in_lyr_path)
 
@@ -109,7 +110,7 @@ def hand_rasterize(in_lyr_path: str, template_dem_path: str, out_raster_path: st
         height=height,
         width=width,
         burnValues=1, outputType=gdal.GDT_Int16,
-        creationOptions=['COMPRESS=LZW'],
+        creationOptions=creation_options if creation_options is not None else ['COMPRESS=LZW'],
         allTouched=True,
         # outputBounds --- assigned output bounds: [minx, miny, maxx, maxy]
         outputBounds=[xmin, ymin, xmax, ymax],
@@ -126,22 +127,25 @@ def run_subprocess(cwd: str, cmd: List[str]):
     log = Logger("Subprocess")
     log.info('Running command: {}'.format(' '.join(cmd)))
     start_time = time.time()
-    # Realtime logging from subprocess
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
-    # Here we print the lines in real time but we will also log them afterwords
-    # replace '' with b'' for Python 3
-    for output in iter(process.stdout.readline, b''):
-        for line in output.decode('utf-8').split('\n'):
-            if len(line) > 0:
-                log.info(line)
-
-    for errout in iter(process.stderr.readline, b''):
-        for line in errout.decode('utf-8').split('\n'):
-            if len(line) > 0:
-                log.error(line)
-
-    retcode = process.poll()
-    if retcode is not None and retcode > 0:
+    # Realtime logging from subprocess. Lines are logged and dropped as they arrive so that chatty
+    # MPI runs don't pile up in memory, and stderr is drained on its own thread so neither pipe can fill and block.
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, bufsize=1, universal_newlines=True,
+                               encoding='utf-8', errors='replace')
+
+    def log_stderr():
+        for line in process.stderr:
+            if len(line.rstrip()) > 0:
+                log.error(line.rstrip())
+
+    stderr_thread = threading.Thread(target=log_stderr, daemon=True)
+    stderr_thread.start()
+    for line in process.stdout:
+        if len(line.rstrip()) > 0:
+            log.info(line.rstrip())
+    stderr_thread.join()
+
+    retcode = process.wait()
+    if retcode > 0:
         log.error('Process returned with code {}'.format(retcode))
 
     ellapsed_time = time.time() - start_time
@@ -26,6 +26,9 @@ from rscommons.classes.vector_base import VectorBaseException
 
 Path = str
 
+# Number of geometries unioned together before their partial union is set aside
+UNION_CHUNK_SIZE = 500
+
 
 def print_geom_size(logger: Logger, geom_obj: BaseGeometry):
     try:
@@ -36,6 +39,25 @@ def print_geom_size(logger: Logger, geom_obj: BaseGeometry):
         logger.debug('Byte Size of output object could not be determined')
 
 
+def chunked_unary_union(geoms: List[BaseGeometry], chunk_size: int = UNION_CHUNK_SIZE) -> BaseGeometry:
+    """Union a list of geometries chunk by chunk, then union the partial results
+
+    GEOS slows down badly when a single unary_union is run over a large, dense set of polygons.
+
+    Args:
+        geoms (List[BaseGeometry]): geometries to union
+        chunk_size (int, optional): number of geometries per chunk. Defaults to UNION_CHUNK_SIZE.
+
+    Returns:
+        BaseGeometry: unioned geometry or None if there is nothing to union
+    """
+    if len(geoms) == 0:
+        return None
+
+    partials = [unary_union(geoms[i:i + chunk_size]) for i in range(0, len(geoms), chunk_size)]
+    return chunked_unary_union(partials, chunk_size) if len(partials) > 1 else partials[0]
+
+
 def get_geometry_union(in_layer_path: str, epsg: int = None,
                        attribute_filter: str = None,
                        clip_shape: BaseGeometry = None,
@@ -114,6 +136,7 @@ def get_geometry_unary_union(in_layer_path: str, epsg: int = None, spatial_ref:
             transform = in_layer.get_transform(in_layer.spatial_ref, spatial_ref)
 
         geom_list = []
+        partials = []
 
         for feature, _counter, progbar in in_layer.iterate_features("Unary Unioning features", attribute_filter=attribute_filter, clip_shape=clip_shape, clip_rect=clip_rect):
             new_geom = feature.GetGeometryRef()
@@ -146,17 +169,20 @@ def get_geometry_unary_union(in_layer_path: str, epsg: int = None, spatial_ref:
             else:
                 geom_list.append(VectorBase.ogr2shapely(new_geom, transform))
 
-                # IF we get past a certain size then run the union
-                if len(geom_list) >= 500:
-                    geom_list = [unary_union(geom_list)]
+                # IF we get past a certain size then union this chunk and set it aside. Folding each
+                # chunk into one growing union gets slower with every chunk
+                if len(geom_list) >= UNION_CHUNK_SIZE:
+                    partials.append(unary_union(geom_list))
+                    geom_list = []
             new_geom = None
 
+    geom_list = partials + geom_list
     log.debug('finished iterating with list of size: {}'.format(len(geom_list)))
 
     if len(geom_list) > 1:
         log.debug('Starting final union of geom_list of size: {}'.format(len(geom_list)))
         # Do a final union to clean up anything that might still be in the list
-        geom_union = unary_union(geom_list)
+        geom_union = chunked_unary_union(geom_list)
     elif len(geom_list) == 0:
         log.warning('No geometry found to union')
         return None
@@ -780,7 +806,13 @@ def polygonize(raster_path: str, band: int, out_layer_path: str, epsg: int = Non
             # double dfProgress, char const * pszMessage=None, void * pData=None
             progbar.update(int(progress * 100))
 
+        # Without a transaction a geopackage commits every polygon Polygonize writes on its own
+        use_transaction = out_layer.ogr_layer.TestCapability(ogr.OLCTransactions)
+        if use_transaction:
+            out_layer.ogr_layer.StartTransaction()
         gdal.Polygonize(src_band, src_ds.GetRasterBand(band), out_layer.ogr_layer, 0, [], callback=poly_progress)
+        if use_transaction:
+            out_layer.ogr_layer.CommitTransaction()
         progbar.finish()
 
     src_ds = None
@@ -801,20 +833,26 @@ def remove_holes(geom: BaseGeometry, min_hole_area: float) -> BaseGeometry:
     """
 
     def _simpl(geo):
-        return Polygon(geo.exterior, list(filter(lambda x: Polygon(x).area > min_hole_area, geo.interiors)))
-
-    if type(geom) == Polygon:
+        # Rebuilding a polygon copies every coordinate, so only do it when a hole actually goes
+        interiors = geo.interiors
+        if len(interiors) == 0:
+            return geo
         if min_hole_area is None:
             # Remove all holes if we don't specify a min area
-            return Polygon(geom.exterior)
-        else:
-            return _simpl(geom)
+            return Polygon(geo.exterior)
+        keep = [ring for ring in interiors if Polygon(ring).area > min_hole_area]
+        if len(keep) == len(interiors):
+            return geo
+        return Polygon(geo.exterior, keep)
+
+    if type(geom) == Polygon:
+        return _simpl(geom)
     elif type(geom) == MultiPolygon:
-        if min_hole_area is None:
-            # Remove all holes if we don't specify a min area
-            return MultiPolygon([Polygon(mgeo.exterior) for mgeo in geom.geoms])
-        else:
-            return MultiPolygon([_simpl(mgeo) for mgeo in geom.geoms])
+        parts_in = list(geom.geoms)
+        parts = [_simpl(mgeo) for mgeo in parts_in]
+        if all(part is mgeo for part, mgeo in zip(parts, parts_in)):
+            return geom
+        return MultiPolygon(parts)
     else:
         raise VectorBaseException('Invalid geometry type used for "remove_holes": {}'.format(type(geom)))
 
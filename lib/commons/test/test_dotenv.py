@@ -1,8 +1,10 @@
 """ Testing for the vector ops
 
 """
+import os
+import tempfile
 import unittest
-from rscommons.dotenv import replace_env_varts
+from rscommons.dotenv import replace_env_varts, parse_dotenv
 
 
 class DotEnvTest(unittest.TestCase):
@@ -33,3 +35,26 @@ class DotEnvTest(unittest.TestCase):
 
         new_str = replace_env_varts(pattern, '"{env:DATA_ROOT}/{env:SECOND}/blah,/${input:SECOND}/blah/blah"', env)
         self.assertEqual(new_str, '"FOUND1/FOUND2/blah,/${input:SECOND}/blah/blah"')
+
+    def test_parse_dotenv_cache(self):
+        """parse_dotenv returns cached values until the file changes
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env_path = os.path.join(tmpdir, '.env')
+            with open(env_path, 'w') as f:
+                f.write('# comment\nDATA_ROOT=/first\n')
+
+            first = parse_dotenv(env_path)
+            self.assertEqual(first, {'DATA_ROOT': '/first'})
+
+            # Mutating the returned dict must not leak into the cache
+            first['DATA_ROOT'] = 'changed'
+            self.assertEqual(parse_dotenv(env_path), {'DATA_ROOT': '/first'})
+
+            with open(env_path, 'w') as f:
+                f.write('DATA_ROOT=/second\n')
+            stat = os.stat(env_path)
+            os.utime(env_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+            self.assertEqual(parse_dotenv(env_path), {'DATA_ROOT': '/second'})
+
+        self.assertEqual(parse_dotenv(env_path), {})
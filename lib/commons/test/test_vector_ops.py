@@ -5,6 +5,7 @@ import unittest
 import os
 from tempfile import mkdtemp
 from osgeo import ogr
+from shapely.geometry import Polygon, MultiPolygon
 from rscommons import vector_ops
 from rscommons import Logger, ShapefileLayer, GeopackageLayer, initGDALOGRErrors
 from rscommons.util import safe_remove_dir
@@ -226,3 +227,26 @@ class VectorOpsTest(unittest.TestCase):
         self.assertEqual(len(values.keys()), 2)
         for shp_obj in values.values():
             self.assertGreater(shp_obj.area, 0)
+
+    def test_remove_holes(self):
+        """[summary]
+        """
+        shell = [(0, 0), (100, 0), (100, 100), (0, 100)]
+        small_hole = [(10, 10), (12, 10), (12, 12), (10, 12)]
+        big_hole = [(50, 50), (80, 50), (80, 80), (50, 80)]
+        poly = Polygon(shell, [small_hole, big_hole])
+
+        result = vector_ops.remove_holes(poly, 10)
+        self.assertEqual(len(result.interiors), 1)
+        self.assertAlmostEqual(result.area, 100 * 100 - 30 * 30)
+
+        self.assertEqual(len(vector_ops.remove_holes(poly, None).interiors), 0)
+
+        # Nothing to remove so the geometry comes back untouched
+        no_holes = Polygon(shell)
+        self.assertIs(vector_ops.remove_holes(no_holes, 10), no_holes)
+
+        multi = MultiPolygon([poly, Polygon([(200, 0), (300, 0), (300, 100), (200, 100)])])
+        result_multi = vector_ops.remove_holes(multi, 10)
+        self.assertEqual(len(result_multi.geoms), 2)
+        self.assertAlmostEqual(result_multi.area, multi.area + 4)
@@ -48,7 +48,9 @@ class AnalysisWindow:
                         geom_window_sections.AddGeometry(geo)
             else:
                 geom_window_sections.AddGeometry(geom)
-        geom_window = geom_window_sections.Buffer(buffer)
+        geom_window = geom_window_sections.UnionCascaded() if not geom_window_sections.IsEmpty() else geom_window_sections
+        if buffer != 0:
+            geom_window = geom_window.Buffer(buffer)
         return geom_window
 
     @cached_property
@@ -22,14 +22,14 @@ from osgeo import ogr
 from osgeo import gdal
 import numpy as np
 import rasterio
-from rasterio.mask import mask
-from shapely.geometry import Point
+from rasterio.windows import Window
+from shapely.strtree import STRtree
 
 from rscommons import GeopackageLayer, dotenv, Logger, initGDALOGRErrors, ModelConfig, RSLayer, RSMeta, RSMetaTypes, RSProject, VectorBase, ProgressBar
 from rscommons.classes.vector_base import get_utm_zone_epsg
 from rscommons.util import parse_metadata, pretty_duration
 from rscommons.database import load_lookup_data
-from rscommons.geometry_ops import reduce_precision, get_endpoints
+from rscommons.geometry_ops import reduce_precision
 from rscommons.vector_ops import copy_feature_class, collect_linestring
 from rscommons.vbet_network import copy_vaa_attributes, join_attributes
 from rscommons.augment_lyr_meta import augment_layermeta, add_layer_descriptions
@@ -302,27 +302,49 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
     # store moving windows of igos for later summarization
     windows = moving_window_dgo_ids(points, segments, level_paths_to_run, window_distance)
 
-    # associate single DGOs with single IGOs for non moving window metrics
+    # Read the dgo and igo attribute columns once rather than running a filtered layer query per feature
     log.info('Associating DGOs with IGOs')
+    with sqlite3.connect(outputs_gpkg) as conn:
+        curs = conn.cursor()
+        curs.execute('SELECT fid, level_path, seg_distance FROM dgos WHERE level_path IS NOT NULL AND seg_distance IS NOT NULL')
+        dgo_lookup = {}
+        for dgo_id, level_path, seg_distance in curs.fetchall():
+            dgo_lookup.setdefault((int(level_path), float(seg_distance)), dgo_id)
+        curs.execute('SELECT fid, level_path, seg_distance, stream_size FROM igos WHERE level_path IS NOT NULL AND seg_distance IS NOT NULL')
+        igo_rows = curs.fetchall()
+
+    # associate single DGOs with single IGOs for non moving window metrics
     igo_dgo = {}
-    with GeopackageLayer(segments) as lyr_segments, \
-            GeopackageLayer(points) as lyr_points:
-        for feat, *_ in lyr_points.iterate_features():
-            igo_id = feat.GetFID()
-            level_path = feat.GetField('level_path')
-            seg_distance = feat.GetField('seg_distance')
-            sql = f'level_path = {level_path} and seg_distance = {seg_distance}'
-            for feat_seg, *_ in lyr_segments.iterate_features(attribute_filter=sql):
-                igo_dgo[igo_id] = feat_seg.GetFID()
-                break
+    igo_stream_size = {}
+    for igo_id, level_path, seg_distance, stream_size_id in igo_rows:
+        key = (int(level_path), float(seg_distance))
+        igo_stream_size.setdefault(key, stream_size_id)
+        if key in dgo_lookup:
+            igo_dgo[igo_id] = dgo_lookup[key]
 
     metrics = generate_metric_list(outputs_gpkg)
     measurements = generate_metric_list(outputs_gpkg, 'measurements')
 
-    buffer_distance = {}
+    # endpoint elevation search radii (in pixels) only depend on stream size, so work them out once up front
+    with rasterio.open(dem) as src_dem:
+        cell_size = abs(src_dem.transform.a)
+    endpoint_radii = {}
     for stream_size, distance in gradient_buffer_lookup.items():
         buffer = VectorBase.rough_convert_metres_to_raster_units(dem, distance)
-        buffer_distance[stream_size] = buffer
+        endpoint_radii[stream_size] = buffer / cell_size
+
+    # Load the flowline network into a spatial index once for the metrics that summarize intersecting flowlines
+    line_features = []
+    line_tree = None
+    if any(code in metrics for code in ['STRMORDR', 'HEDWTR', 'STRMLENGTH']):
+        with GeopackageLayer(line_network) as lyr_lines:
+            for feat, *_ in lyr_lines.iterate_features('Indexing flowlines'):
+                line_features.append({
+                    'geom': feat.GetGeometryRef().Clone(),
+                    'stream_order': feat.GetField('stream_order'),
+                    'STARTFLAG': feat.GetField('STARTFLAG')
+                })
+        line_tree = STRtree([VectorBase.ogr2shapely(line['geom'].Clone()) for line in line_features], range(len(line_features)))
 
     progbar = ProgressBar(len(level_paths_to_run), 50,
                           "Calculating Riverscapes Metrics")
@@ -349,6 +371,9 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
             geom_centerline = collect_linestring(
                 centerlines, f'level_path = {level_path}', precision=8)
 
+            # neighbouring dgos share endpoints, so keep endpoint elevations for the whole level path
+            elevation_cache = {}
+
             for feat_seg_dgo, *_ in lyr_segments.iterate_features(attribute_filter=f'level_path = {level_path}'):
                 # Gather common components for metric calcuations
                 feat_geom = feat_seg_dgo.GetGeometryRef().Clone()
@@ -356,14 +381,8 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 segment_distance = feat_seg_dgo.GetField('seg_distance')
                 if segment_distance is None:
                     continue
-                # stream_size_id = feat_seg_pt.GetField('stream_size')
-                # curs.execute("SELECT stream_size from points WHERE seg_distance = ? and LevelPathI = ?", (segment_distance, level_path))
-                # stream_size_id = curs.fetchone()[0]
-                with GeopackageLayer(points) as lyr_points:
-                    for pt_ftr, *_ in lyr_points.iterate_features(attribute_filter=f'level_path = {level_path} and seg_distance = {segment_distance}'):
-                        stream_size_id = pt_ftr.GetField('stream_size')
-                        break
-                if not 'stream_size_id' in locals():
+                stream_size_id = igo_stream_size.get((int(level_path), float(segment_distance)))
+                if stream_size_id is None:
                     log.warning(f'Unable to find stream size for dgo {dgo_id} in level path {level_path}')
                     stream_size_id = 0
 
@@ -371,48 +390,46 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 # window_geoms = {}  # Different metrics may require different windows. Store generated windows here for reuse.
                 metrics_output = {}
                 measurements_output = {}
-                min_elev = None
-                max_elev = None
+
+                # Flowline and centerline measurements are shared by several metrics, so measure each line once per dgo
+                stream_length, min_elev, max_elev = None, None, None
+                centerline_length = None
+                if any(code in metrics for code in ['STRMGRAD', 'VALGRAD', 'RELFLWLNGTH', 'STRMSIZE']):
+                    stream_length, min_elev, max_elev = get_segment_measurements(
+                        geom_flowline, src_dem, feat_geom, endpoint_radii[stream_size], transform, elevation_cache)
+                if any(code in metrics for code in ['VALGRAD', 'RELFLWLNGTH']):
+                    centerline_length, *_ = get_segment_measurements(
+                        geom_centerline, src_dem, feat_geom, endpoint_radii[stream_size], transform, elevations=False)
 
                 # Calculate each metric if it is active
                 if 'STRMGRAD' in metrics:
                     metric = metrics['STRMGRAD']
 
-                    stream_length, min_elev, max_elev = get_segment_measurements(
-                        geom_flowline, src_dem, feat_geom, buffer_distance[stream_size], transform)
                     measurements_output[measurements['STRMMINELEV']['measurement_id']] = min_elev
                     measurements_output[measurements['STRMMAXELEV']['measurement_id']] = max_elev
                     measurements_output[measurements['STRMLENG']['measurement_id']] = stream_length
-
-                    gradient = None if any(value is None for value in [max_elev, min_elev]) else str(
-                        (max_elev - min_elev) / stream_length)
-                    metrics_output[metric['metric_id']] = gradient
+                    metrics_output[metric['metric_id']] = calculate_gradient(min_elev, max_elev, stream_length)
 
                 if 'VALGRAD' in metrics:
                     metric = metrics['VALGRAD']
 
-                    centerline_length, *_ = get_segment_measurements(
-                        geom_centerline, src_dem, feat_geom, buffer_distance[stream_size], transform)
                     measurements_output[measurements['VALLENG']['measurement_id']] = centerline_length
+                    measurements_output[measurements['STRMMINELEV']['measurement_id']] = min_elev
+                    measurements_output[measurements['STRMMAXELEV']['measurement_id']] = max_elev
+                    metrics_output[metric['metric_id']] = calculate_gradient(min_elev, max_elev, centerline_length)
 
-                    if any(elev is None for elev in [min_elev, max_elev]):
-                        _, min_elev, max_elev = get_segment_measurements(
-                            geom_flowline, dem, feat_geom, buffer_distance[stream_size], transform)
-                        measurements_output[measurements['STRMMINELEV']['measurement_id']] = min_elev
-                        measurements_output[measurements['STRMMAXELEV']['measurement_id']] = max_elev
-
-                    gradient = None if any(value is None for value in [max_elev, min_elev]) else str(
-                        (max_elev - min_elev) / centerline_length)
-                    metrics_output[metric['metric_id']] = gradient
+                # flowlines intersecting the dgo and their clipped sections, shared by the flowline network metrics
+                dgo_lines = []
+                if line_tree is not None:
+                    for line_id in line_tree.query_items(VectorBase.ogr2shapely(feat_geom.Clone())):
+                        line = line_features[line_id]
+                        if feat_geom.Intersects(line['geom']):
+                            dgo_lines.append((line, feat_geom.Intersection(line['geom'])))
 
                 if 'STRMORDR' in metrics:
                     metric = metrics['STRMORDR']
 
-                    results = []
-                    with GeopackageLayer(line_network) as lyr_lines:
-                        for feat, *_ in lyr_lines.iterate_features(clip_shape=feat_geom):
-                            results.append(feat.GetField('stream_order'))
-                        lyr_lines.ogr_layer.SetSpatialFilter(None)
+                    results = [line['stream_order'] for line, _section in dgo_lines]
                     if len(results) > 0:
                         stream_order = str(max(results))
                     else:
@@ -425,18 +442,12 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                     metric = metrics['HEDWTR']
 
                     sum_attributes = {}
-                    with GeopackageLayer(line_network) as lyr_lines:
-                        for feat, *_ in lyr_lines.iterate_features(clip_shape=feat_geom):
-                            line_geom = feat.GetGeometryRef()
-                            attribute = str(feat.GetField('STARTFLAG'))
-                            if attribute not in ['1', '0']:
-                                continue
-                            geom_section = feat_geom.Intersection(line_geom)
-                            length = geom_section.Length()
-                            sum_attributes[attribute] = sum_attributes.get(
-                                attribute, 0) + length
-                        lyr_lines.ogr_layer.SetSpatialFilter(None)
-                        lyr_lines = None
+                    for line, geom_section in dgo_lines:
+                        attribute = str(line['STARTFLAG'])
+                        if attribute not in ['1', '0']:
+                            continue
+                        sum_attributes[attribute] = sum_attributes.get(
+                            attribute, 0) + geom_section.Length()
                     if sum(sum_attributes.values()) == 0:
                         is_headwater = None
                     else:
@@ -446,34 +457,13 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 if 'STRMTYPE' in metrics:
                     metric = metrics['STRMTYPE']
 
-                    # attributes = {}
-                    # with GeopackageLayer(line_network) as lyr_lines:
-                    #     for feat, *_ in lyr_lines.iterate_features(clip_shape=feat_geom):
-                    #         line_geom = feat.GetGeometryRef()
-                    #         attribute = str(feat.GetField('FCode'))
-                    #         geom_section = feat_geom.Intersection(line_geom)
-                    #         length = geom_section.Length()
-                    #         attributes[attribute] = attributes.get(attribute, 0) + length
-                    #     lyr_lines.ogr_layer.SetSpatialFilter(None)
-                    #     lyr_lines = None
-                    # if len(attributes) == 0:
-                    #     majority_fcode = None
-                    # else:
-                    #     majority_fcode = str(max(attributes, key=attributes.get))
                     fcode = feat_seg_dgo.GetField('FCode')
                     metrics_output[metric['metric_id']] = str(fcode)
 
                 if 'STRMLENGTH' in metrics:
                     metric = metrics['STRMLENGTH']
 
-                    with GeopackageLayer(line_network) as lyr_lines:
-                        leng = 0
-                        for feat, *_ in lyr_lines.iterate_features(clip_shape=feat_geom):
-                            geom_flowline_full = feat.GetGeometryRef()
-                            feat_section = geom_flowline_full.Intersection(feat_geom)
-                            section_proj = VectorBase.ogr2shapely(feat_section, transform=transform)
-                            leng += section_proj.length
-                        lyr_lines = None
+                    leng = sum(projected_length(geom_section, transform) for _line, geom_section in dgo_lines)
                     metrics_output[metric['metric_id']] = str(leng)
 
                 if 'ACTFLDAREA' in metrics:
@@ -557,22 +547,13 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 if 'RELFLWLNGTH' in metrics:
                     metric = metrics['RELFLWLNGTH']
 
-                    geom_flowline_full = collect_linestring(line_network, f'level_path = {level_path}')
-                    stream_length_total, *_ = get_segment_measurements(
-                        geom_flowline_full, src_dem, feat_geom, buffer_distance[stream_size], transform)
-                    centerline_length, *_ = get_segment_measurements(
-                        geom_centerline, src_dem, feat_geom, buffer_distance[stream_size], transform)
-
                     relative_flow_length = str(
-                        stream_length_total / centerline_length) if centerline_length > 0.0 else None
+                        stream_length / centerline_length) if centerline_length > 0.0 else None
                     metrics_output[metric['metric_id']] = relative_flow_length
 
                 if 'STRMSIZE' in metrics:
                     metric = metrics['STRMSIZE']
 
-                    stream_length, *_ = get_segment_measurements(
-                        geom_flowline, src_dem, feat_geom, buffer_distance[stream_size], transform)
-
                     stream_size_metric = str(feat_seg_dgo.GetField(
                         'active_channel_area') / stream_length) if stream_length > 0.0 else None
                     metrics_output[metric['metric_id']] = stream_size_metric
@@ -938,6 +919,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                     # curs.executemany("INSERT INTO measurement_values (dgo_id, measurement_id, measurement_value) VALUES (?,?,?)", [(dgo_id, name, value) for name, value in measurements_output.items()])
 
         with sqlite3.connect(outputs_gpkg) as conn:
+            set_bulk_insert_pragmas(conn)
             curs = conn.cursor()
             for dgo_id, vals in lp_metrics.items():
                 curs.executemany("INSERT INTO dgo_metric_values (dgo_id, metric_id, metric_value) VALUES (?,?,?)", [
@@ -947,14 +929,18 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                                  (dgo_id, name, value) for name, value in vals.items()])
             conn.commit()
 
-    # fill out igo_metrics table using moving window analysis
+    # fill out igo_metrics table using moving window analysis, reusing one tuned connection for all igos
+    igo_conn = sqlite3.connect(outputs_gpkg)
+    set_bulk_insert_pragmas(igo_conn)
     progbar = ProgressBar(
         len(windows), 50, "Calculating Moving Window Metrics")
     counter = 0
     for igo_id, dgo_ids in windows.items():
         counter += 1
         progbar.update(counter)
-        with sqlite3.connect(outputs_gpkg) as conn:
+        # the window's dgo id list is shared by every metric query below, so format it once per igo
+        dgo_ids_sql = ','.join([str(dgo_id) for dgo_id in dgo_ids])
+        with igo_conn as conn:
             curs = conn.cursor()
 
             if igo_id in igo_dgo.keys():
@@ -1108,17 +1094,17 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
 
             if 'STRMGRAD' in metrics:
                 curs.execute(
-                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMMINELEV']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMMINELEV']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                 elevs = [float(row[0])
                          for row in curs.fetchall() if row[0] is not None]
                 min_elev = min(elevs) if len(elevs) > 0 else None
                 curs.execute(
-                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMMAXELEV']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMMAXELEV']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                 elevs = [float(row[0])
                          for row in curs.fetchall() if row[0] is not None]
                 max_elev = max(elevs) if len(elevs) > 0 else None
                 curs.execute(
-                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMLENG']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMLENG']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                 stream_length = sum([float(row[0]) for row in curs.fetchall()])
                 gradient = None if any(value is None for value in [
                                        max_elev, min_elev, stream_length]) else (max_elev - min_elev) / stream_length
@@ -1128,18 +1114,18 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
 
             if 'VALGRAD' in metrics:
                 curs.execute(
-                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                 cl = [float(row[0])
                       for row in curs.fetchall() if row[0] is not None]
                 centerline_length = sum(cl) if len(cl) > 0 else None
                 if any(elev is None for elev in [min_elev, max_elev]):
                     curs.execute(
-                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMMINELEV']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMMINELEV']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                     elevs = [float(row[0])
                              for row in curs.fetchall() if row[0] is not None]
                     min_elev = min(elevs) if len(elevs) > 0 else None
                     curs.execute(
-                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMMAXELEV']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMMAXELEV']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                     elevs = [float(row[0])
                              for row in curs.fetchall() if row[0] is not None]
                     max_elev = max(elevs) if len(elevs) > 0 else None
@@ -1152,12 +1138,12 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
             if 'INTGWDTH' in metrics:
                 if centerline_length is None:
                     curs.execute(
-                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                     cl = [float(row[0])
                           for row in curs.fetchall() if row[0] is not None]
                     centerline_length = sum(cl) if len(cl) > 0 else None
                 curs.execute(
-                    f"SELECT segment_area FROM dgos WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT segment_area FROM dgos WHERE fid IN ({dgo_ids_sql})")
                 sa = [float(row[0])
                       for row in curs.fetchall() if row[0] is not None]
                 segment_area = sum(sa) if len(sa) > 0 else None
@@ -1169,13 +1155,13 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
 
             if 'CHANVBRAT' in metrics:
                 curs.execute(
-                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['ACTCHANAREA']['metric_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['ACTCHANAREA']['metric_id']} AND dgo_id IN ({dgo_ids_sql})")
                 ac = [float(row[0])
                       for row in curs.fetchall() if row[0] is not None]
                 ac_area = sum(ac) if len(ac) > 0 else None
                 if segment_area is None:
                     curs.execute(
-                        f"SELECT segment_area FROM dgos WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT segment_area FROM dgos WHERE fid IN ({dgo_ids_sql})")
                     sa = [float(row[0])
                           for row in curs.fetchall() if row[0] is not None]
                     segment_area = sum(sa) if len(sa) > 0 else None
@@ -1187,13 +1173,13 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
 
             if 'LOWLYVBRAT' in metrics:
                 curs.execute(
-                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['ACTFLDAREA']['metric_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['ACTFLDAREA']['metric_id']} AND dgo_id IN ({dgo_ids_sql})")
                 afp = [float(row[0])
                        for row in curs.fetchall() if row[0] is not None]
                 afp_area = sum(afp) if len(afp) > 0 else None
                 if segment_area is None:
                     curs.execute(
-                        f"SELECT segment_area FROM dgos WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT segment_area FROM dgos WHERE fid IN ({dgo_ids_sql})")
                     sa = [float(row[0])
                           for row in curs.fetchall() if row[0] is not None]
                     segment_area = sum(sa) if len(sa) > 0 else None
@@ -1205,13 +1191,13 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
 
             if 'ELEVATEDVBRAT' in metrics:
                 curs.execute(
-                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['INACTFLDAREA']['metric_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['INACTFLDAREA']['metric_id']} AND dgo_id IN ({dgo_ids_sql})")
                 ifp = [float(row[0])
                        for row in curs.fetchall() if row[0] is not None]
                 ifp_area = sum(ifp) if len(ifp) > 0 else None
                 if segment_area is None:
                     curs.execute(
-                        f"SELECT segment_area FROM dgos WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT segment_area FROM dgos WHERE fid IN ({dgo_ids_sql})")
                     sa = [float(row[0])
                           for row in curs.fetchall() if row[0] is not None]
                     segment_area = sum(sa) if len(sa) > 0 else None
@@ -1223,13 +1209,13 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
 
             if 'FLDVBRAT' in metrics:
                 curs.execute(
-                    f"SELECT floodplain_area FROM dgos WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT floodplain_area FROM dgos WHERE fid IN ({dgo_ids_sql})")
                 fp = [float(row[0])
                       for row in curs.fetchall() if row[0] is not None]
                 fp_area = sum(fp) if len(fp) > 0 else None
                 if segment_area is None:
                     curs.execute(
-                        f"SELECT segment_area FROM dgos WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT segment_area FROM dgos WHERE fid IN ({dgo_ids_sql})")
                     sa = [float(row[0])
                           for row in curs.fetchall() if row[0] is not None]
                     segment_area = sum(sa) if len(sa) > 0 else None
@@ -1242,14 +1228,14 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
             if 'ACRESVBPM' in metrics:
                 if segment_area is None:
                     curs.execute(
-                        f"SELECT segment_area FROM dgos WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT segment_area FROM dgos WHERE fid IN ({dgo_ids_sql})")
                     sa = [float(row[0])
                           for row in curs.fetchall() if row[0] is not None]
                     segment_area = sum(sa) if len(sa) > 0 else None
                 seg_area = segment_area * 0.000247105 if segment_area is not None else None
                 if centerline_length is None:
                     curs.execute(
-                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                     cl = [float(row[0])
                           for row in curs.fetchall() if row[0] is not None]
                     centerline_length = sum(cl) if len(cl) > 0 else None
@@ -1263,14 +1249,14 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
             if 'HECTVBPKM' in metrics:
                 if segment_area is None:
                     curs.execute(
-                        f"SELECT segment_area FROM dgos WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT segment_area FROM dgos WHERE fid IN ({dgo_ids_sql})")
                     sa = [float(row[0])
                           for row in curs.fetchall() if row[0] is not None]
                     segment_area = sum(sa) if len(sa) > 0 else None
                 seg_area = segment_area * 0.0001 if segment_area is not None else None
                 if centerline_length is None:
                     curs.execute(
-                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                     cl = [float(row[0])
                           for row in curs.fetchall() if row[0] is not None]
                     centerline_length = sum(cl) if len(cl) > 0 else None
@@ -1283,13 +1269,13 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
             if 'RELFLWLNGTH' in metrics:
                 if centerline_length is None:
                     curs.execute(
-                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                     cl = [float(row[0])
                           for row in curs.fetchall() if row[0] is not None]
                     centerline_length = sum(cl) if len(cl) > 0 else None
                 if stream_length is None:
                     curs.execute(
-                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMSTRLENG']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMSTRLENG']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                     sl = [float(row[0])
                           for row in curs.fetchall() if row[0] is not None]
                     stream_length = sum(sl) if len(sl) > 0 else None
@@ -1302,11 +1288,11 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
             if 'TRIBS' in metrics:
                 if stream_length is None:
                     curs.execute(
-                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMLENG']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMLENG']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                     stream_length = sum([float(row[0])
                                         for row in curs.fetchall()])
                 curs.execute(
-                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['TRIBS']['metric_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['TRIBS']['metric_id']} AND dgo_id IN ({dgo_ids_sql})")
                 count3 = sum([float(row[0]) for row in curs.fetchall()])
                 if stream_length <= 0.0:
                     trib_dens = None
@@ -1319,10 +1305,10 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
 
             if 'CHANSIN' in metrics:
                 curs.execute(
-                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['CHANSIN']['metric_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['CHANSIN']['metric_id']} AND dgo_id IN ({dgo_ids_sql})")
                 sinuos = [row[0] for row in curs.fetchall()]
                 curs.execute(
-                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMLENG']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['STRMLENG']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                 lens = [row[0] for row in curs.fetchall()]
                 sin_f = [float(s) for i, s in enumerate(sinuos)
                          if s is not None and lens[i] is not None]
@@ -1343,10 +1329,10 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
 
             if 'VALAZMTH' in metrics:
                 curs.execute(
-                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['VALAZMTH']['metric_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT metric_value FROM dgo_metric_values WHERE metric_id = {metrics['VALAZMTH']['metric_id']} AND dgo_id IN ({dgo_ids_sql})")
                 azs = [float(row[0]) for row in curs.fetchall()]
                 curs.execute(
-                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                    f"SELECT measurement_value FROM measurement_values WHERE measurement_id = {measurements['VALLENG']['measurement_id']} AND dgo_id IN ({dgo_ids_sql})")
                 lens = [float(row[0]) for row in curs.fetchall()]
                 azs_f = [float(a) for i, a in enumerate(
                     azs) if a is not None and lens[i] is not None]
@@ -1369,7 +1355,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 with sqlite3.connect(inputs_gpkg) as conn:
                     curs2 = conn.cursor()
                     curs2.execute(
-                        f"SELECT confin_leng, approx_leng FROM confinement_dgo WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT confin_leng, approx_leng FROM confinement_dgo WHERE fid IN ({dgo_ids_sql})")
                     confs = curs2.fetchall()
                     conf_ratio = sum([c[0] for c in confs]) / sum([c[1]
                                                                    for c in confs]) if sum([c[1] for c in confs]) > 0 else None
@@ -1381,7 +1367,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 with sqlite3.connect(inputs_gpkg) as conn:
                     curs2 = conn.cursor()
                     curs2.execute(
-                        f"SELECT constr_leng, approx_leng FROM confinement_dgo WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT constr_leng, approx_leng FROM confinement_dgo WHERE fid IN ({dgo_ids_sql})")
                     cons = curs2.fetchall()
                     cons_ratio = sum([c[0] for c in cons]) / sum([c[1]
                                                                   for c in cons]) if sum([c[1] for c in cons]) > 0 else None
@@ -1393,7 +1379,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 with sqlite3.connect(inputs_gpkg) as conn:
                     curs2 = conn.cursor()
                     curs2.execute(
-                        f"SELECT Road_len, centerline_length FROM anthro_dgo WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT Road_len, centerline_length FROM anthro_dgo WHERE fid IN ({dgo_ids_sql})")
                     roadd = curs2.fetchall()
                     rds = [r[0] for r in roadd if r[0] is not None]
                     cls = [r[1] for r in roadd if r[1] is not None]
@@ -1406,7 +1392,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 with sqlite3.connect(inputs_gpkg) as conn:
                     curs2 = conn.cursor()
                     curs2.execute(
-                        f"SELECT Rail_len, centerline_length FROM anthro_dgo WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT Rail_len, centerline_length FROM anthro_dgo WHERE fid IN ({dgo_ids_sql})")
                     raild = curs2.fetchall()
                     rls = [r[0] for r in raild if r[0] is not None]
                     cls = [r[1] for r in raild if r[1] is not None]
@@ -1420,7 +1406,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 with sqlite3.connect(inputs_gpkg) as conn:
                     curs2 = conn.cursor()
                     curs2.execute(
-                        f"SELECT LUI, segment_area FROM anthro_dgo WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT LUI, segment_area FROM anthro_dgo WHERE fid IN ({dgo_ids_sql})")
                     luivals = curs2.fetchall()
                     lui = sum(luivals[i][0] * luivals[i][1] for i in range(len(luivals))) / sum([luivals[i][1]
                                                                                                  for i in range(len(luivals))]) if sum([luivals[i][1] for i in range(len(luivals))]) > 0.0 else None
@@ -1432,7 +1418,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 with sqlite3.connect(inputs_gpkg) as conn:
                     curs2 = conn.cursor()
                     curs2.execute(
-                        f"SELECT FloodplainAccess, segment_area FROM rcat_dgo WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT FloodplainAccess, segment_area FROM rcat_dgo WHERE fid IN ({dgo_ids_sql})")
                     fpacc = curs2.fetchall()
                     fp_access = sum(fpacc[i][0] * fpacc[i][1] for i in range(len(fpacc))) / sum([fpacc[i][1]
                                                                                                  for i in range(len(fpacc))]) if sum([fpacc[i][1] for i in range(len(fpacc))]) > 0.0 else None
@@ -1444,7 +1430,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 with sqlite3.connect(inputs_gpkg) as conn:
                     curs2 = conn.cursor()
                     curs2.execute(
-                        f"SELECT ExistingRiparianMean, segment_area FROM rcat_dgo WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT ExistingRiparianMean, segment_area FROM rcat_dgo WHERE fid IN ({dgo_ids_sql})")
                     rip = curs2.fetchall()
                     proprip = sum(rip[i][0] * rip[i][1] for i in range(len(rip))) / sum([rip[i][1]
                                                                                          for i in range(len(rip))]) if sum([rip[i][1] for i in range(len(rip))]) > 0.0 else None
@@ -1456,7 +1442,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 with sqlite3.connect(inputs_gpkg) as conn:
                     curs2 = conn.cursor()
                     curs2.execute(
-                        f"SELECT RiparianDeparture, segment_area FROM rcat_dgo WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT RiparianDeparture, segment_area FROM rcat_dgo WHERE fid IN ({dgo_ids_sql})")
                     rvd = curs2.fetchall()
                     rvd_val = sum((1 - min(rvd[i][0], 1)) * rvd[i][1] for i in range(len(rvd))) / sum([rvd[i][1]
                                                                                                        for i in range(len(rvd))]) if sum([rvd[i][1] for i in range(len(rvd))]) > 0.0 else None
@@ -1468,7 +1454,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 with sqlite3.connect(inputs_gpkg) as conn:
                     curs2 = conn.cursor()
                     curs2.execute(
-                        f"SELECT Agriculture, segment_area FROM rcat_dgo WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT Agriculture, segment_area FROM rcat_dgo WHERE fid IN ({dgo_ids_sql})")
                     agconv = curs2.fetchall()
                     agconv_val = sum(agconv[i][0] * agconv[i][1] for i in range(len(agconv))) / sum([agconv[i][1]
                                                                                                      for i in range(len(agconv))]) if sum([agconv[i][1] for i in range(len(agconv))]) > 0.0 else None
@@ -1480,7 +1466,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 with sqlite3.connect(inputs_gpkg) as conn:
                     curs2 = conn.cursor()
                     curs2.execute(
-                        f"SELECT Development, segment_area FROM rcat_dgo WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT Development, segment_area FROM rcat_dgo WHERE fid IN ({dgo_ids_sql})")
                     devel = curs2.fetchall()
                     devel_val = sum(devel[i][0] * devel[i][1] for i in range(len(devel))) / sum([devel[i][1]
                                                                                                  for i in range(len(devel))]) if sum([devel[i][1] for i in range(len(devel))]) > 0.0 else None
@@ -1492,7 +1478,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
                 with sqlite3.connect(inputs_gpkg) as conn:
                     curs2 = conn.cursor()
                     curs2.execute(
-                        f"SELECT oCC_EX, centerline_length FROM brat_dgo WHERE fid IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])})")
+                        f"SELECT oCC_EX, centerline_length FROM brat_dgo WHERE fid IN ({dgo_ids_sql})")
                     caps = curs2.fetchall()
                     brat_cap = sum(caps[i][0] * (caps[i][1]/1000) for i in range(len(caps))) / (sum([caps[i][1] for i in range(len(caps))])/1000) if sum([caps[i][1] for i in range(len(caps))]) > 0.0 else None
                 if brat_cap is not None:
@@ -1501,7 +1487,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
 
             if 'BRATRISK' in metrics and brat_dgos:
                 metric = metrics['BRATRISK']
-                curs.execute(f"SELECT metric_value from dgo_metric_values WHERE dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])}) AND metric_id = {metric['metric_id']}")
+                curs.execute(f"SELECT metric_value from dgo_metric_values WHERE dgo_id IN ({dgo_ids_sql}) AND metric_id = {metric['metric_id']}")
                 bratr = curs.fetchall()
                 bratrisk = [row[0] for row in bratr if row[0] is not None]
                 bratrisk_val = max(set(bratrisk), key=bratrisk.count) if len(bratrisk) > 0 else None
@@ -1511,7 +1497,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
 
             if 'BRATOPP' in metrics and brat_dgos:
                 metric = metrics['BRATOPP']
-                curs.execute(f"SELECT metric_value from dgo_metric_values WHERE dgo_id IN ({','.join([str(dgo_id) for dgo_id in dgo_ids])}) AND metric_id = {metric['metric_id']}")
+                curs.execute(f"SELECT metric_value from dgo_metric_values WHERE dgo_id IN ({dgo_ids_sql}) AND metric_id = {metric['metric_id']}")
                 brato = curs.fetchall()
                 bratopp = [row[0] for row in brato if row[0] is not None]
                 bratopp_val = max(set(bratopp), key=bratopp.count) if len(bratopp) > 0 else None
@@ -1521,6 +1507,7 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
 
             conn.commit()
     progbar.finish()
+    igo_conn.close()
 
     epsg = 4326
     with sqlite3.connect(outputs_gpkg) as conn:
@@ -1538,10 +1525,12 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
         metric_values_sql = ", ".join(
             [f"{sql_round(metric['data_type'], metric['metric_id'])} {sql_name(metric['field_name'])}" for metric in number_metrics.values()])
 
-        sql = f'CREATE VIEW dgo_num_metrics (fid, {num_metric_names_sql}) AS SELECT M.dgo_id, {metric_values_sql} FROM dgo_metric_values M GROUP BY M.dgo_id;'
-        curs.execute(sql)
-        sql2 = f"""CREATE VIEW igo_num_metrics (fid, {num_metric_names_sql}) AS SELECT M.igo_id, {metric_values_sql} FROM igo_metric_values M GROUP BY M.igo_id;"""
-        curs.execute(sql2)
+        # Materialize the numeric pivots so the metric views don't re-aggregate the metric values on every read
+        num_metric_columns_sql = ", ".join([f"{sql_name(metric['field_name'])} {metric['data_type']}" for metric in number_metrics.values()])
+        for prefix in ['dgo', 'igo']:
+            curs.execute(f'CREATE TABLE {prefix}_num_metrics (fid INTEGER PRIMARY KEY, {num_metric_columns_sql});')
+            curs.execute(f'INSERT INTO {prefix}_num_metrics (fid, {num_metric_names_sql}) SELECT M.{prefix}_id, {metric_values_sql} FROM {prefix}_metric_values M GROUP BY M.{prefix}_id;')
+        conn.commit()
 
         curs.execute(f"""CREATE VIEW dgo_text_metrics(fid, {text_metric_names_sql}) AS SELECT dgo.fid, o.ownership, s.us_state, c.county, e.ecoregion3, f.ecoregion4, br.bratrisk, bo.bratopp FROM dgos dgo LEFT JOIN
                      (SELECT dgo_id, metric_value AS ownership FROM dgo_metric_values WHERE metric_id={metrics['AGENCY']['metric_id']}) o ON o.dgo_id=dgo.fid LEFT JOIN
@@ -1645,6 +1634,14 @@ def metric_engine(huc: int, in_flowlines: Path, in_vaa_table: Path, in_counties:
     return
 
 
+def set_bulk_insert_pragmas(conn: sqlite3.Connection):
+    """relax journaling and syncing on a connection used for bulk metric inserts
+
+    These pragmas only last for the life of the connection, so the geopackage keeps its defaults afterwards.
+    """
+    conn.executescript("PRAGMA synchronous=OFF; PRAGMA journal_mode=MEMORY; PRAGMA cache_size=-262144; PRAGMA temp_store=MEMORY;")
+
+
 def sql_name(name: str) -> str:
     """return cleaned metric column name"""
     return name.lower().replace(' ', '_')
@@ -1702,21 +1699,144 @@ def generate_window(lyr: GeopackageLayer, window: float, level_path: str, segmen
                     geom_window_sections.AddGeometry(geo)
         else:
             geom_window_sections.AddGeometry(geom)
-    # ogr.ForceToPolygon(geom_window_sections)
-    geom_window = geom_window_sections.Buffer(buffer)
+    # dissolve the sections with a cascaded union rather than the slower Buffer(0) idiom
+    geom_window = geom_window_sections.UnionCascaded() if not geom_window_sections.IsEmpty() else geom_window_sections
+    if buffer != 0:
+        geom_window = geom_window.Buffer(buffer)
 
     return geom_window
 
 
-def get_segment_measurements(geom_line: ogr.Geometry, src_raster: rasterio.DatasetReader, geom_window: ogr.Geometry, buffer: float, transform) -> tuple:
+def circular_stencil(radius: float, row_offset: float = 0.0, col_offset: float = 0.0) -> np.ndarray:
+    """ boolean circular footprint in pixel units
+
+    Args:
+        radius (float): radius of the circle in pixels
+        row_offset (float, optional): row position of the circle center relative to the center pixel's center. Defaults to 0.0.
+        col_offset (float, optional): column position of the circle center relative to the center pixel's center. Defaults to 0.0.
+
+    Returns:
+        np.ndarray: square boolean array centered on the center pixel, True for pixels whose centers fall within the radius
+    """
+
+    size = int(np.ceil(radius + max(abs(row_offset), abs(col_offset))))
+    rows, cols = np.ogrid[-size:size + 1, -size:size + 1]
+
+    return (rows - row_offset)**2 + (cols - col_offset)**2 <= radius**2
+
+
+def line_parts(geom: ogr.Geometry) -> list:
+    """ return the non-empty linestring parts of a linestring or multilinestring
+
+    Args:
+        geom (ogr.Geometry): linestring or multilinestring geometry
+
+    Returns:
+        list: linestring geometries
+    """
+
+    parts = [geom] if geom.GetGeometryName() == 'LINESTRING' else [geom.GetGeometryRef(i) for i in range(geom.GetGeometryCount())]
+
+    return [part for part in parts if part.GetGeometryName() == 'LINESTRING' and part.GetPointCount() > 0]
+
+
+def line_endpoints(geom: ogr.Geometry) -> list:
+    """ return the endpoints of a linestring or multilinestring that are not shared between parts
+
+    Args:
+        geom (ogr.Geometry): linestring or multilinestring geometry
+
+    Returns:
+        list: coords of points
+    """
+
+    ends = [np.asarray(part.GetPoints())[[0, -1], :2] for part in line_parts(geom)]
+    if len(ends) == 0:
+        return []
+    coords, counts = np.unique(np.vstack(ends), axis=0, return_counts=True)
+
+    return [tuple(pnt) for pnt in coords[counts == 1]]
+
+
+def projected_length(geom: ogr.Geometry, transform) -> float:
+    """ length of a linestring or multilinestring after transforming its vertices
+
+    Args:
+        geom (ogr.Geometry): linestring or multilinestring geometry
+        transform (CoordinateTransform): transform to a projected coordinate system
+
+    Returns:
+        float: length in projected units
+    """
+
+    length = 0.0
+    for part in line_parts(geom):
+        if part.GetPointCount() < 2:
+            continue
+        coords = np.asarray(transform.TransformPoints(part.GetPoints()))[:, :2]
+        length += float(np.hypot(*np.diff(coords, axis=0).T).sum())
+
+    return length
+
+
+def get_endpoint_elevation(src_raster: rasterio.DatasetReader, pnt: tuple, radius: float, cache: dict = None) -> float:
+    """ minimum raster value of the cells whose centers are within radius of a point
+
+    The stencil is centered on the point itself rather than on the pixel that contains it, so it picks
+    the same cells as masking the raster with a buffer of the point. (The buffer polygon only approximates
+    the circle, so cells whose centers sit right on the edge can still differ.)
+
+    Args:
+        src_raster (rasterio.DatasetReader): open dataset reader of elevation raster
+        pnt (tuple): x, y coordinates of point
+        radius (float): search radius in pixels
+        cache (dict, optional): previously sampled elevations keyed by rounded coordinates and radius. Defaults to None.
+
+    Returns:
+        float: minimum elevation, or None if there are no valid cells under the stencil
+    """
+
+    key = (round(pnt[0], 8), round(pnt[1], 8), radius)
+    if cache is not None and key in cache:
+        return cache[key]
+
+    # fractional pixel position of the point and its offset from the center of the pixel containing it
+    col_frac, row_frac = ~src_raster.transform * (pnt[0], pnt[1])
+    row, col = int(np.floor(row_frac)), int(np.floor(col_frac))
+    stencil = circular_stencil(radius, row_frac - row - 0.5, col_frac - col - 0.5)
+
+    # clip the stencil to the raster so off-raster cells are never read (boundless reads go through a VRT)
+    size = stencil.shape[0] // 2
+    row_start, row_stop = max(row - size, 0), min(row + size + 1, src_raster.height)
+    col_start, col_stop = max(col - size, 0), min(col + size + 1, src_raster.width)
+    if row_start >= row_stop or col_start >= col_stop:
+        elevation = None
+    else:
+        stencil = stencil[row_start - (row - size):row_stop - (row - size), col_start - (col - size):col_stop - (col - size)]
+        data = src_raster.read(1, window=Window(col_start, row_start, col_stop - col_start, row_stop - row_start))
+        if src_raster.nodata is not None:
+            stencil &= ~np.isnan(data) if np.isnan(src_raster.nodata) else data != src_raster.nodata
+        values = data[stencil]
+        elevation = float(values.min()) if values.size > 0 else None  # BRAT uses mean here
+
+    if cache is not None:
+        cache[key] = elevation
+
+    return elevation
+
+
+def get_segment_measurements(geom_line: ogr.Geometry, src_raster: rasterio.DatasetReader, geom_window: ogr.Geometry, radius: float, transform,
+                             elevation_cache: dict = None, elevations: bool = True) -> tuple:
     """ return length of segment and endpoint elevations of a line
 
     Args:
         geom_line (ogr.Geometry): unclipped line geometry
         raster (rasterio.DatasetReader): open dataset reader of elevation raster
         geom_window (ogr.Geometry): analysis window for clipping line
-        buffer (float): buffer of endpoints to find min elevation
+        radius (float): radius in pixels around endpoints to find min elevation
         transform(CoordinateTransform): transform used to obtain length
+        elevation_cache (dict, optional): endpoint elevations shared between calls. Defaults to None.
+        elevations (bool, optional): sample endpoint elevations, otherwise only the length is measured. Defaults to True.
     Returns:
         float: stream length
         float: maximum elevation
@@ -1727,23 +1847,35 @@ def get_segment_measurements(geom_line: ogr.Geometry, src_raster: rasterio.Datas
     if geom_clipped.GetGeometryName() == "MULTILINESTRING":
         geom_clipped = reduce_precision(geom_clipped, 6)
         geom_clipped = ogr.ForceToLineString(geom_clipped)
-    endpoints = get_endpoints(geom_clipped)
-    elevations = [None, None]
-    if len(endpoints) == 2:
-        elevations = []
-        for pnt in endpoints:
-            point = Point(pnt)
+    endpoint_elevs = [None, None]
+    if elevations is True:
+        endpoints = line_endpoints(geom_clipped)
+        if len(endpoints) == 2:
             # BRAT uses 100m here for all stream sizes?
-            polygon = point.buffer(buffer)
-            raw_raster, _out_transform = mask(src_raster, [polygon], crop=True)
-            mask_raster = np.ma.masked_values(raw_raster, src_raster.nodata)
-            value = float(mask_raster.min())  # BRAT uses mean here
-            elevations.append(value)
-        elevations.sort()
-    geom_clipped.Transform(transform)
-    stream_length = geom_clipped.Length()
-
-    return stream_length, elevations[0], elevations[1]
+            values = [get_endpoint_elevation(src_raster, pnt, radius, elevation_cache) for pnt in endpoints]
+            if None not in values:
+                endpoint_elevs = sorted(values)
+    stream_length = projected_length(geom_clipped, transform)
+
+    return stream_length, endpoint_elevs[0], endpoint_elevs[1]
+
+
+def calculate_gradient(min_elev: float, max_elev: float, length: float) -> str:
+    """ gradient between two elevations over a length
+
+    Args:
+        min_elev (float): lower elevation
+        max_elev (float): upper elevation
+        length (float): length between elevations
+
+    Returns:
+        str: gradient as a metric value string, None if it cannot be calculated
+    """
+
+    if min_elev is None or max_elev is None or not length:
+        return None
+
+    return str((max_elev - min_elev) / length)
 
 
 def sum_window_attributes(lyr: GeopackageLayer, window: float, level_path: str, segment_dist: float, fields: list) -> dict:
@@ -1,7 +1,5 @@
 import sqlite3
-import json
 from osgeo import ogr
-from shapely.geometry import mapping
 from rscommons.classes.vector_base import VectorBase
 
 
@@ -28,7 +26,7 @@ def clean_nhdplus_catchments(gpkg_path: str, huc_boundary_lyr: str, hucid: str):
     bound = geom.boundary
 
     catchlyr = nhdsrc.GetLayerByName("NHDPlusCatchment")
-    catchlyr.SetSpatialFilter(ogr.CreateGeometryFromJson(json.dumps(mapping(bound))))
+    catchlyr.SetSpatialFilter(ogr.CreateGeometryFromWkb(bound.wkb))
 
     del_ids = []
 
@@ -15,9 +15,11 @@ import traceback
 import datetime
 import time
 import sqlite3
+from math import floor, ceil
 from typing import List, Dict
 import rasterio
 from rasterio import features
+from rasterio.windows import Window
 from osgeo import ogr, gdal, osr
 import numpy as np
 from rscommons.classes.rs_project import RSMeta, RSMetaTypes
@@ -332,28 +334,22 @@ def rvd(huc: int, flowlines_orig: Path, existing_veg_orig: Path, historic_veg_or
             raw_values_unique = {}
             change_values_mean = {}
             riparian_values_mean = {}
-            reach_raster = np.ma.masked_invalid(
-                features.rasterize(
-                    [poly],
-                    out_shape=dataset.shape,
-                    transform=dataset.transform,
-                    all_touched=True,
-                    fill=np.nan))
+            reach_slices, reach_mask = reach_window_mask(poly, dataset)
             for raster_name, raster in raw_arrays.items():
                 if raster is not None:
-                    current_raster = np.ma.masked_array(raster, mask=reach_raster.mask)
+                    current_raster = np.ma.masked_array(raster[reach_slices], mask=reach_mask)
                     raw_values_unique[raster_name] = np.unique(np.ma.filled(current_raster, fill_value=0), return_counts=True)
                 else:
                     raw_values_unique[raster_name] = []
             for raster_name, raster in riparian_arrays.items():
                 if raster is not None:
-                    current_raster = np.ma.masked_array(raster, mask=reach_raster.mask)
+                    current_raster = np.ma.masked_array(raster[reach_slices], mask=reach_mask)
                     riparian_values_mean[raster_name] = np.ma.mean(current_raster)
                 else:
                     riparian_values_mean[raster_name] = 0.0
             for raster_name, raster in vegetation_change_arrays.items():
                 if raster is not None:
-                    current_raster = np.ma.masked_array(raster, mask=reach_raster.mask)
+                    current_raster = np.ma.masked_array(raster[reach_slices], mask=reach_mask)
                     change_values_mean[raster_name] = np.ma.mean(current_raster)
                 else:
                     change_values_mean[raster_name] = 0.0
@@ -517,6 +513,39 @@ def rvd(huc: int, flowlines_orig: Path, existing_veg_orig: Path, historic_veg_or
     log.info('RVD complete')
 
 
+def reach_window_mask(poly, dataset):
+    """Rasterize a reach polygon over just the part of the raster it covers
+
+    Rasterizing every reach to the full raster shape allocates and scans a whole raster per reach.
+
+    Args:
+        poly (BaseGeometry): reach polygon
+        dataset (rasterio.DatasetReader): raster the polygon is rasterized against
+
+    Returns:
+        (tuple, np.ndarray): slices of the raster array covering the polygon and a mask that is True outside the polygon
+    """
+    minx, miny, maxx, maxy = poly.bounds
+    col_min, row_min = ~dataset.transform * (minx, maxy)
+    col_max, row_max = ~dataset.transform * (maxx, miny)
+    # Pad by a cell so all_touched never reaches past the window
+    col_off = max(int(floor(min(col_min, col_max))) - 1, 0)
+    row_off = max(int(floor(min(row_min, row_max))) - 1, 0)
+    col_end = min(int(ceil(max(col_min, col_max))) + 1, dataset.width)
+    row_end = min(int(ceil(max(row_min, row_max))) + 1, dataset.height)
+
+    if col_end <= col_off or row_end <= row_off:
+        # Polygon is off the raster. Keep a single fully masked cell so the statistics stay masked
+        return (slice(0, 1), slice(0, 1)), np.ones((1, 1), dtype=bool)
+
+    window = Window(col_off, row_off, col_end - col_off, row_end - row_off)
+    mask = features.geometry_mask([poly],
+                                  out_shape=(window.height, window.width),
+                                  transform=dataset.window_transform(window),
+                                  all_touched=True)
+    return window.toslices(), mask
+
+
 def extract_mean_values_by_polygon(polys, rasters, reference_raster):
     log = Logger('extract_mean_values_by_polygon')
 
@@ -533,17 +562,11 @@ def extract_mean_values_by_polygon(polys, rasters, reference_raster):
             if poly.geom_type in ["Polygon", "MultiPolygon"] and poly.area > 0:
                 values_mean = {}
                 values_unique = {}
-                reach_raster = np.ma.masked_invalid(
-                    features.rasterize(
-                        [poly],
-                        out_shape=dataset.shape,
-                        transform=dataset.transform,
-                        all_touched=True,
-                        fill=np.nan))
+                reach_slices, reach_mask = reach_window_mask(poly, dataset)
 
                 for key, raster in rasters.items():
                     if raster is not None:
-                        current_raster = np.ma.masked_array(raster, mask=reach_raster.mask)
+                        current_raster = np.ma.masked_array(raster[reach_slices], mask=reach_mask)
                         values_mean[key] = np.ma.mean(current_raster)
                         values_unique[key] = np.unique(np.ma.filled(current_raster, fill_value=0), return_counts=True)
                     else:
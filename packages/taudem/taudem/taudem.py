@@ -13,12 +13,15 @@ import sys
 import traceback
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, List
 
 # LEave OSGEO import alone. It is necessary even if it looks unused
 from osgeo import gdal, osr
 from osgeo.ogr import Layer
+import numpy as np
 import rasterio
+from rasterio.windows import Window
 from rscommons.classes.vector_classes import get_shp_or_gpkg, VectorBase
 from rscommons.classes.rs_project import RSMeta, RSMetaTypes
 from rscommons.util import safe_makedirs, parse_metadata, pretty_duration
@@ -39,7 +42,16 @@ Path = str
 
 cfg = ModelConfig('https://xml.riverscapes.net/Projects/XSD/V2/RiverscapesProject.xsd', __version__)
 
-NCORES = os.environ['TAUDEM_CORES'] if 'TAUDEM_CORES' in os.environ else '2'
+# Leave TAUDEM_CORES unset to size the number of MPI processes from the DEM
+NCORES = os.environ['TAUDEM_CORES'] if 'TAUDEM_CORES' in os.environ else None
+# Roughly how many DEM cells each MPI process should get before adding another one pays off
+CELLS_PER_CORE = 2000000
+GDAL_CACHE_MB = int(os.environ['TAUDEM_GDAL_CACHE_MB']) if 'TAUDEM_GDAL_CACHE_MB' in os.environ else 4096
+# Creation options for intermediates that are read again by later TauDEM stages
+TILED_DEFLATE_OPTIONS = ['COMPRESS=DEFLATE', 'PREDICTOR=3', 'TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER']
+# Set TAUDEM_PITFILL=priority_flood to fill pits with RichDEM instead of TauDEM pitremove
+PITFILL_METHOD = os.environ['TAUDEM_PITFILL'] if 'TAUDEM_PITFILL' in os.environ else 'pitremove'
+PITFILL_METHODS = ['pitremove', 'priority_flood']
 
 LYR_DESCRIPTIONS_JSON = os.path.join(os.path.dirname(__file__), 'layer_descriptions.json')
 LayerTypes = {
@@ -73,7 +85,8 @@ LayerTypes = {
 }
 
 
-def taudem(huc: int, input_channel_vector: Path, orig_dem: Path, project_folder: Path, mask_lyr_path: Path = None, epsg: int = cfg.OUTPUT_EPSG, meta: Dict[str, str] = None):
+def taudem(huc: int, input_channel_vector: Path, orig_dem: Path, project_folder: Path, mask_lyr_path: Path = None, epsg: int = cfg.OUTPUT_EPSG, meta: Dict[str, str] = None,
+           resume: bool = False):
     """Run TauDEM tools to generate a Riverscapes TauDEM project, including HAND, TWI, Dinf Slope and other intermediate raster products.
 
     Args:
@@ -84,9 +97,15 @@ def taudem(huc: int, input_channel_vector: Path, orig_dem: Path, project_folder:
         project_folder (Path): Output folder for TauDEM project
         mask_lyr_path (Path, optional): polygon layer to mask DEM. Defaults to None.
         meta (Dict[str, str], optional): metadata to include in project. Defaults to None.
+        resume (bool, optional): skip TauDEM stages whose outputs are newer than their inputs. Defaults to False.
     """
 
     log = Logger('TauDEM')
+
+    # Catch typos before any work is done rather than quietly falling back to pitremove
+    if PITFILL_METHOD not in PITFILL_METHODS:
+        raise Exception(f'Unknown TAUDEM_PITFILL method "{PITFILL_METHOD}". Use one of: {", ".join(PITFILL_METHODS)}')
+
     log.info('Starting TauDEM v.{}'.format(cfg.version))
     start_time = time.time()
     project_name = 'TauDEM project for HUC {}'.format(huc)
@@ -105,19 +124,22 @@ def taudem(huc: int, input_channel_vector: Path, orig_dem: Path, project_folder:
     # Add the layer metadata immediately before we write anything
     augment_layermeta('taudem', LYR_DESCRIPTIONS_JSON, LayerTypes)
 
+    # Absolute path of every project layer, resolved once
+    paths = {key: os.path.join(project_folder, lyr.rel_path) for key, lyr in LayerTypes.items()}
+
     _realization, proj_nodes = project.add_realization(project_name, 'REALIZATION1', cfg.version, data_nodes=["Inputs", "Intermediates", "Outputs"], create_folders=True)
 
     # Copy the inp
-    _dem_node, proj_dem = project.add_project_raster(proj_nodes['Inputs'], LayerTypes['DEM'], orig_dem)
+    _dem_node, proj_dem = project.add_project_raster(proj_nodes['Inputs'], LayerTypes['DEM'], orig_dem, inplace=True)
     orig_hillshade = os.path.join(os.path.dirname(orig_dem), 'dem_hillshade.tif')
     orig_slope = os.path.join(os.path.dirname(orig_dem), 'slope.tif')
-    project.add_project_raster(proj_nodes['Inputs'], LayerTypes['HILLSHADE'], orig_hillshade)
-    project.add_project_raster(proj_nodes['Outputs'], LayerTypes['GDAL_SLOPE'], orig_slope)
+    project.add_project_raster(proj_nodes['Inputs'], LayerTypes['HILLSHADE'], orig_hillshade, inplace=True)
+    project.add_project_raster(proj_nodes['Outputs'], LayerTypes['GDAL_SLOPE'], orig_slope, inplace=True)
     # if hillshade is not None:
     #    _hillshade_node, hillshade = project.add_project_raster(proj_nodes['Inputs'], LayerTypes['HILLSHADE'], hillshade)
 
     # Find EPSG from dem
-    dem = os.path.join(project_folder, LayerTypes['DEM'].rel_path)
+    dem = paths['DEM']
     d = gdal.Open(dem)
     proj = osr.SpatialReference(wkt=d.GetProjection())
     epsg = int(proj.GetAttrValue('AUTHORITY', 1))
@@ -126,7 +148,7 @@ def taudem(huc: int, input_channel_vector: Path, orig_dem: Path, project_folder:
     cell_meters = cell_resolution / GeopackageLayer.rough_convert_metres_to_raster_units(dem, 1) if epsg == 4326 else cell_resolution
 
     # Copy input shapes to a geopackage
-    inputs_gpkg_path = os.path.join(project_folder, LayerTypes['INPUTS'].rel_path)
+    inputs_gpkg_path = paths['INPUTS']
     GeopackageLayer.delete(inputs_gpkg_path)
 
     with get_shp_or_gpkg(input_channel_vector) as in_layer:
@@ -156,15 +178,67 @@ def taudem(huc: int, input_channel_vector: Path, orig_dem: Path, project_folder:
     # If there's no mask we use the original DEM as-is
     hand_dem = proj_dem
 
-    # We might need to mask the incoming DEM
-    if mask_lyr_path is not None:
-        new_proj_dem = os.path.join(project_folder, LayerTypes['DEM_MASKED'].rel_path)
-        raster_warp(proj_dem, new_proj_dem, epsg=epsg, clip=dem_mask_path, raster_compression=" -co COMPRESS=LZW -co PREDICTOR=3")
-        hand_dem = new_proj_dem
-
-    path_rasterized_drainage = os.path.join(project_folder, LayerTypes['RASTERIZED_CHANNEL'].rel_path)
-    hand_rasterize(channel_vector, hand_dem, path_rasterized_drainage)
-    _raster_channel_node, raster_channel = project.add_project_raster(proj_nodes['Intermediates'], LayerTypes['RASTERIZED_CHANNEL'])
+    # Give the in-process warp, rasterize and pitfill steps a larger block cache and all cores, then put GDAL back the way
+    # we found it. This is process-wide, so it is only restored on this thread once the background rasterize is done
+    prev_cache_max = gdal.GetCacheMax()
+    prev_num_threads = gdal.GetConfigOption('GDAL_NUM_THREADS')
+    gdal.SetCacheMax(GDAL_CACHE_MB * 1024 * 1024)
+    gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+    try:
+        # We might need to mask the incoming DEM
+        if mask_lyr_path is not None:
+            new_proj_dem = paths['DEM_MASKED']
+            raster_warp(proj_dem, new_proj_dem, epsg=epsg, clip=dem_mask_path,
+                        warp_options={'multithread': True, 'warpOptions': ['NUM_THREADS=ALL_CPUS'], 'warpMemoryLimit': 2048},
+                        raster_compression=" -co COMPRESS=DEFLATE -co PREDICTOR=3 -co TILED=YES -co BLOCKXSIZE=512 -co BLOCKYSIZE=512 -co NUM_THREADS=ALL_CPUS -co BIGTIFF=YES")
+            hand_dem = new_proj_dem
+
+        # The rasterized channel isn't needed until dinfdistdown, so build it in the background while the DEM is filled
+        path_rasterized_drainage = paths['RASTERIZED_CHANNEL']
+        with ThreadPoolExecutor(max_workers=1) as rasterize_executor:
+            # Channels cover a small part of the DEM, so leave the empty tiles unwritten
+            rasterize_future = rasterize_executor.submit(hand_rasterize, channel_vector, hand_dem, path_rasterized_drainage,
+                                                         ['COMPRESS=DEFLATE', 'TILED=YES', 'SPARSE_OK=TRUE'])
+
+            start_time = time.time()
+            log.info('Starting TauDEM processes')
+
+            ncores = NCORES if NCORES is not None else auto_cores(hand_dem)
+            log.info(f'Running TauDEM with {ncores} processes')
+
+            # TauDEM Products
+            # PitRemove
+            log.info("Filling DEM pits")
+            path_pitfill = paths['PITFILL']
+            # The project DEM and channel are re-copied on every run, so resume compares the first stages against the source files instead
+            source_inputs = [orig_dem] + ([VectorBase.path_sorter(mask_lyr_path)[0]] if mask_lyr_path is not None else [])
+            if resume is True and stage_is_current(source_inputs, [path_pitfill]):
+                log.info('Skipping pitfill, outputs are up to date')
+            else:
+                if PITFILL_METHOD == 'priority_flood':
+                    pitfill_status = priority_flood_pitfill(hand_dem, path_pitfill)
+                else:
+                    pitfill_status = run_subprocess(intermediates_path, mpi_command(ncores, ["pitremove", "-z", hand_dem, "-fel", path_pitfill]))
+                if pitfill_status != 0 or not os.path.isfile(path_pitfill):
+                    raise Exception('TauDEM: pitfill failed')
+                tile_raster(path_pitfill)
+            _pitfill_node, pitfill_raster = project.add_project_raster(proj_nodes['Intermediates'], LayerTypes['PITFILL'])
+
+            # Flow Dir
+            log.info("Finding dinf flow direction")
+            path_ang = paths['DINFFLOWDIR_ANG']
+            path_slp = paths['DINFFLOWDIR_SLP']
+            if run_taudem_stage(intermediates_path, 'dinfflowdir', mpi_command(ncores, ["dinfflowdir", "-fel", path_pitfill, "-ang", path_ang, "-slp", path_slp]), [path_ang],
+                                [path_pitfill], resume):
+                tile_raster(path_ang)
+                tile_raster(path_slp)
+            _dinfd_ang_node, dinf_ang_raster = project.add_project_raster(proj_nodes['Intermediates'], LayerTypes['DINFFLOWDIR_ANG'])
+            _dinfd_slp_node, dinf_slp_raster = project.add_project_raster(proj_nodes['Outputs'], LayerTypes['DINFFLOWDIR_SLP'])
+
+            rasterize_future.result()
+    finally:
+        gdal.SetCacheMax(prev_cache_max)
+        gdal.SetConfigOption('GDAL_NUM_THREADS', prev_num_threads)
 
     # GDAL Products
     # Hillshade
@@ -183,73 +257,55 @@ def taudem(huc: int, input_channel_vector: Path, orig_dem: Path, project_folder:
     #     gdal.DEMProcessing(gdal_slope, hand_dem, 'slope')
     # project.add_project_raster(proj_nodes['Outputs'], LayerTypes['GDAL_SLOPE'])
 
-    start_time = time.time()
-    log.info('Starting TauDEM processes')
-
-    # TauDEM Products
-    # PitRemove
-    log.info("Filling DEM pits")
-    path_pitfill = os.path.join(project_folder, LayerTypes['PITFILL'].rel_path)
-    pitfill_status = run_subprocess(intermediates_path, ["mpiexec", "-n", NCORES, "pitremove", "-z", hand_dem, "-fel", path_pitfill])
-    if pitfill_status != 0 or not os.path.isfile(path_pitfill):
-        raise Exception('TauDEM: pitfill failed')
-    _pitfill_node, pitfill_raster = project.add_project_raster(proj_nodes['Intermediates'], LayerTypes['PITFILL'])
-
-    # Flow Dir
-    log.info("Finding dinf flow direction")
-    path_ang = os.path.join(project_folder, LayerTypes['DINFFLOWDIR_ANG'].rel_path)
-    path_slp = os.path.join(project_folder, LayerTypes['DINFFLOWDIR_SLP'].rel_path)
-    dinfflowdir_status = run_subprocess(intermediates_path, ["mpiexec", "-n", NCORES, "dinfflowdir", "-fel", path_pitfill, "-ang", path_ang, "-slp", path_slp])
-    if dinfflowdir_status != 0 or not os.path.isfile(path_ang):
-        raise Exception('TauDEM: dinfflowdir failed')
-    _dinfd_ang_node, dinf_ang_raster = project.add_project_raster(proj_nodes['Intermediates'], LayerTypes['DINFFLOWDIR_ANG'])
-    _dinfd_slp_node, dinf_slp_raster = project.add_project_raster(proj_nodes['Outputs'], LayerTypes['DINFFLOWDIR_SLP'])
-
-    # generate hand
-    log.info("Generating HAND")
-    hand_raster = os.path.join(project_folder, LayerTypes['HAND_RASTER'].rel_path)
-    dinfdistdown_status = run_subprocess(intermediates_path, ["mpiexec", "-n", NCORES, "dinfdistdown", "-ang", path_ang, "-fel", path_pitfill, "-src", path_rasterized_drainage, "-dd", hand_raster, "-m", "ave", "v"])
-    if dinfdistdown_status != 0 or not os.path.isfile(hand_raster):
-        raise Exception('TauDEM: dinfdistdown failed')
-    _hand_node, hand_ras = project.add_project_raster(proj_nodes['Outputs'], LayerTypes['HAND_RASTER'])
+    if not os.path.isfile(path_rasterized_drainage):
+        raise Exception('TauDEM: channel rasterize failed')
+    _raster_channel_node, raster_channel = project.add_project_raster(proj_nodes['Intermediates'], LayerTypes['RASTERIZED_CHANNEL'])
 
-    # Generate Flow area
-    log.info("Finding flow area")
-    path_sca = os.path.join(project_folder, LayerTypes['AREADINF_SCA'].rel_path)
-    dinfflowarea_status = run_subprocess(intermediates_path, ["mpiexec", "-n", NCORES, "areadinf", "-ang", path_ang, "-sca", path_sca, "-nc"])
-    if dinfflowarea_status != 0 or not os.path.isfile(path_sca):
-        raise Exception('TauDEM: AreaDinf failed')
-    _area_dinf_node, area_dinf_raster = project.add_project_raster(proj_nodes['Outputs'], LayerTypes['AREADINF_SCA'])
+    hand_raster = paths['HAND_RASTER']
+    path_sca = paths['AREADINF_SCA']
+    path_slp_reclass = paths['DINFFLOWDIR_SLP_RECLASS']
+    twi_raster = paths['TWI_RASTER']
 
-    # Reclass slope to remove 0
-    log.info(f"Reclass zero slope for {path_slp}")
-    path_slp_reclass = os.path.join(project_folder, LayerTypes['DINFFLOWDIR_SLP_RECLASS'].rel_path)
+    # HAND and the flow area -> TWI chain only depend on the flow directions, so run the two branches side by side
+    branch_cores = str(max(1, int(ncores) // 2))
 
-    with rasterio.open(path_slp) as rio_slope:
-        out_meta = rio_slope.meta
-        out_meta['compress'] = 'lzw'
-        with rasterio.open(path_slp_reclass, 'w', **out_meta) as rio_out:
-            progbar = ProgressBar(len(list(rio_slope.block_windows(1))), 50, "Reclassifying zero-slope values ")
-            counter = 0
-            for _ji, window in rio_slope.block_windows(1):
-                progbar.update(counter)
-                counter += 1
-                data = rio_slope.read(1, window=window, masked=True)
-                data[data == 0] = 0.0001
-                rio_out.write(data, window=window, indexes=1)
-            progbar.finish()
+    def twi_branch():
+        log.info("Finding flow area")
+        if run_taudem_stage(intermediates_path, 'AreaDinf', mpi_command(branch_cores, ["areadinf", "-ang", path_ang, "-sca", path_sca, "-nc"]), [path_sca], [path_ang], resume):
+            tile_raster(path_sca)
+
+        # Reclass slope to remove 0
+        if resume is True and stage_is_current([path_slp], [path_slp_reclass]):
+            log.info('Skipping zero slope reclass, outputs are up to date')
+        else:
+            log.info(f"Reclass zero slope for {path_slp}")
+            reclass_zero_slope(path_slp, path_slp_reclass)
+
+        # TWI is a cell by cell calculation, so there's no need to pay for an MPI launch
+        if resume is True and stage_is_current([path_slp_reclass, path_sca], [twi_raster]):
+            log.info('Skipping TWI, outputs are up to date')
+        else:
+            log.info("Generating Topographic Wetness Index (TWI)")
+            calculate_twi(path_slp_reclass, path_sca, twi_raster)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        log.info("Generating HAND")
+        futures = [
+            executor.submit(run_taudem_stage, intermediates_path, 'dinfdistdown', mpi_command(branch_cores, ["dinfdistdown", "-ang", path_ang, "-fel", path_pitfill,
+                                                                                               "-src", path_rasterized_drainage, "-dd", hand_raster, "-m", "ave", "v"]), [hand_raster],
+                            [path_ang, path_pitfill, VectorBase.path_sorter(input_channel_vector)[0]], resume),
+            executor.submit(twi_branch)
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+    _hand_node, hand_ras = project.add_project_raster(proj_nodes['Outputs'], LayerTypes['HAND_RASTER'])
+    _area_dinf_node, area_dinf_raster = project.add_project_raster(proj_nodes['Outputs'], LayerTypes['AREADINF_SCA'])
 
     # reclass_status = run_subprocess(intermediates_path, ['gdal_calc.py', '-A', path_slp, '--outfile', path_slp_reclass, '--calc=(A==0)*0.0001+(A>0)*A', '--co=COMPRESS=LZW'])
     # if reclass_status != 0 or not os.path.isfile(path_slp_reclass):
     #     raise Exception('TauDEM: reclass slope failed')
     _flowdir_node, flow_dir_raster = project.add_project_raster(proj_nodes['Intermediates'], LayerTypes['DINFFLOWDIR_SLP_RECLASS'])
-
-    # Generate TWI
-    log.info("Generating Topographic Wetness Index (TWI)")
-    twi_raster = os.path.join(project_folder, LayerTypes['TWI_RASTER'].rel_path)
-    twi_status = run_subprocess(intermediates_path, ["mpiexec", "-n", NCORES, "twi", "-slp", path_slp_reclass, "-sca", path_sca, '-twi', twi_raster])
-    if twi_status != 0 or not os.path.isfile(twi_raster):
-        raise Exception('TauDEM: TWI failed')
     _twi_node, twi_ras = project.add_project_raster(proj_nodes['Outputs'], LayerTypes['TWI_RASTER'])
 
     # Generate SlopeAveDown
@@ -294,7 +350,7 @@ def taudem(huc: int, input_channel_vector: Path, orig_dem: Path, project_folder:
 
     add_layer_descriptions(project, LYR_DESCRIPTIONS_JSON, LayerTypes)
 
-    report_path = os.path.join(project.project_dir, LayerTypes['REPORT'].rel_path)
+    report_path = paths['REPORT']
     project.add_report(proj_nodes['Outputs'], LayerTypes['REPORT'], replace=True)
 
     report = TauDEMReport(report_path, project)
@@ -303,6 +359,192 @@ def taudem(huc: int, input_channel_vector: Path, orig_dem: Path, project_folder:
     log.info('TauDEM Completed Successfully')
 
 
+def auto_cores(dem: Path) -> str:
+    """Pick the number of TauDEM MPI processes from the size of the DEM
+
+    Small DEMs spend more time setting up MPI than computing, so they get fewer processes.
+
+    Args:
+        dem (Path): DEM that TauDEM will process
+
+    Returns:
+        str: number of processes
+    """
+
+    ds = gdal.Open(dem)
+    cells = ds.RasterXSize * ds.RasterYSize
+    ds = None
+
+    return str(min(os.cpu_count() or 1, max(1, cells // CELLS_PER_CORE)))
+
+
+def mpi_command(ncores: str, cmd: List[str]) -> List[str]:
+    """Wrap a TauDEM command in mpiexec, or run it directly when only one process is needed
+
+    Args:
+        ncores (str): number of MPI processes
+        cmd (List[str]): TauDEM command and arguments
+
+    Returns:
+        List[str]: command to run
+    """
+
+    if int(ncores) <= 1:
+        return cmd
+
+    return ["mpiexec", "-n", ncores] + cmd
+
+
+def run_taudem_stage(cwd: Path, name: str, cmd: List[str], outputs: List[Path], inputs: List[Path] = None, resume: bool = False) -> bool:
+    """Run a TauDEM command and make sure it produced its outputs
+
+    Args:
+        cwd (Path): working folder for the subprocess
+        name (str): name of the stage used in the error message
+        cmd (List[str]): command and arguments
+        outputs (List[Path]): rasters the stage must create
+        inputs (List[Path], optional): rasters the stage reads, used to decide if a resumed stage can be skipped. Defaults to None.
+        resume (bool, optional): skip the stage if its outputs are newer than its inputs. Defaults to False.
+
+    Returns:
+        bool: True if the stage ran, False if it was skipped
+    """
+
+    if resume is True and inputs is not None and stage_is_current(inputs, outputs):
+        Logger('TauDEM').info(f'Skipping {name}, outputs are up to date')
+        return False
+
+    status = run_subprocess(cwd, cmd)
+    if status != 0 or not all(os.path.isfile(output) for output in outputs):
+        raise Exception(f'TauDEM: {name} failed')
+
+    return True
+
+
+def stage_is_current(inputs: List[Path], outputs: List[Path]) -> bool:
+    """Check that all outputs of a stage exist and are newer than every input
+
+    Args:
+        inputs (List[Path]): files the stage reads
+        outputs (List[Path]): files the stage writes
+
+    Returns:
+        bool: True if the stage does not need to run again
+    """
+
+    if not all(os.path.exists(output) for output in outputs):
+        return False
+    newest_input = max(os.path.getmtime(path) for path in inputs)
+
+    return all(os.path.getmtime(output) > newest_input for output in outputs)
+
+
+def tile_raster(path: Path):
+    """Rewrite a TauDEM raster in place as a tiled DEFLATE GeoTIFF
+
+    TauDEM writes stripped rasters, which the MPI workers of the following stages read with a lot of overlap.
+
+    Args:
+        path (Path): raster to rewrite
+    """
+
+    tiled_path = f'{os.path.splitext(path)[0]}_tiled.tif'
+    gdal.Translate(tiled_path, path, creationOptions=TILED_DEFLATE_OPTIONS)
+    os.replace(tiled_path, path)
+
+
+def reclass_zero_slope(path_slp: Path, path_slp_reclass: Path):
+    """Replace zero slope values so that TWI does not divide by zero
+
+    Args:
+        path_slp (Path): d-infinity slope raster
+        path_slp_reclass (Path): output reclassed slope raster
+    """
+
+    with rasterio.open(path_slp) as rio_slope:
+        out_meta = rio_slope.meta
+        out_meta['compress'] = 'lzw'
+        with rasterio.open(path_slp_reclass, 'w', **out_meta) as rio_out:
+            progbar = ProgressBar(len(list(rio_slope.block_windows(1))), 50, "Reclassifying zero-slope values ")
+            counter = 0
+            for _ji, window in rio_slope.block_windows(1):
+                progbar.update(counter)
+                counter += 1
+                data = rio_slope.read(1, window=window, masked=True)
+                data[data == 0] = 0.0001
+                rio_out.write(data, window=window, indexes=1)
+            progbar.finish()
+
+
+def calculate_twi(path_slp: Path, path_sca: Path, out_twi: Path):
+    """Calculate the Topographic Wetness Index ln(sca / slope), matching TauDEM twi
+
+    Args:
+        path_slp (Path): d-infinity slope raster (rise over run) with zero slopes reclassed
+        path_sca (Path): d-infinity specific catchment area raster
+        out_twi (Path): output TWI raster
+    """
+
+    with rasterio.open(path_slp) as rio_slope, rasterio.open(path_sca) as rio_sca:
+        out_meta = rio_slope.meta
+        out_meta['dtype'] = 'float32'
+        out_meta['nodata'] = rio_slope.nodata if rio_slope.nodata is not None else -9999.0
+        out_meta['compress'] = 'deflate'
+        out_meta['predictor'] = 3
+        with rasterio.open(out_twi, 'w', **out_meta) as rio_out:
+            # Read 8 x 8 native blocks at a time. One block per read spends most of its time in per-read overhead
+            block_height, block_width = rio_slope.block_shapes[0]
+            chunk_height = min(rio_slope.height, block_height * 8)
+            chunk_width = min(rio_slope.width, block_width * 8)
+            windows = [Window(col_off, row_off, min(chunk_width, rio_slope.width - col_off), min(chunk_height, rio_slope.height - row_off))
+                       for row_off in range(0, rio_slope.height, chunk_height) for col_off in range(0, rio_slope.width, chunk_width)]
+            progbar = ProgressBar(len(windows), 50, "Calculating TWI ")
+            for counter, window in enumerate(windows):
+                progbar.update(counter)
+                slope = rio_slope.read(1, window=window)
+                sca = rio_sca.read(1, window=window)
+                # NaN fails the > 0 tests, so only real nodata values need an explicit comparison
+                valid = (slope > 0) & (sca > 0)
+                if rio_slope.nodata is not None:
+                    valid &= slope != rio_slope.nodata
+                if rio_sca.nodata is not None:
+                    valid &= sca != rio_sca.nodata
+                twi = np.full(slope.shape, out_meta['nodata'], dtype=np.float32)
+                twi[valid] = np.log(sca[valid] / slope[valid])
+                rio_out.write(twi, window=window, indexes=1)
+            progbar.finish()
+
+
+def priority_flood_pitfill(dem: Path, out_pitfill: Path) -> int:
+    """Fill DEM pits with the RichDEM Priority-Flood algorithm as an alternative to TauDEM pitremove
+
+    Args:
+        dem (Path): DEM raster to fill
+        out_pitfill (Path): output pit filled raster
+
+    Returns:
+        int: 0 on success, to match the subprocess status of pitremove
+    """
+    import richdem as rd  # pylint: disable=import-outside-toplevel
+
+    log = Logger('Priority-Flood')
+    log.info(f'Filling DEM pits with Priority-Flood for {dem}')
+
+    rd_dem = rd.LoadGDAL(dem)
+    rd.FillDepressions(rd_dem, epsilon=False, in_place=True)
+
+    # Keep the same raster profile that pitremove would have produced
+    with rasterio.open(dem) as src:
+        out_meta = src.meta
+    out_meta['dtype'] = 'float32'
+    out_meta['compress'] = 'lzw'
+    out_meta['predictor'] = 3
+    with rasterio.open(out_pitfill, 'w', **out_meta) as rio_out:
+        rio_out.write(np.asarray(rd_dem, dtype=np.float32), 1)
+
+    return 0
+
+
 def main():
 
     parser = argparse.ArgumentParser(
@@ -317,6 +559,7 @@ def main():
     parser.add_argument('--mask', help='Optional shapefile to mask by', type=str, default=None)
     parser.add_argument('--epsg', help='Optional output epsg', type=int, default=None)
     parser.add_argument('--meta', help='riverscapes project metadata as comma separated key=value pairs', type=str)
+    parser.add_argument('--resume', help='(optional) skip TauDEM stages whose outputs are already newer than their inputs', action='store_true', default=False)
     parser.add_argument('--verbose', help='(optional) a little extra logging ', action='store_true', default=False)
     parser.add_argument('--debug', help='Add debug tools for tracing things like memory usage at a performance cost.', action='store_true', default=False)
 
@@ -338,11 +581,11 @@ def main():
         if args.debug is True:
             from rscommons.debug import ThreadRun
             memfile = os.path.join(args.output_dir, 'taudem_mem.log')
-            retcode, max_obj = ThreadRun(taudem, memfile, args.huc, args.channel, args.dem, args.output_dir, args.mask, epsg, meta)
+            retcode, max_obj = ThreadRun(taudem, memfile, args.huc, args.channel, args.dem, args.output_dir, args.mask, epsg, meta, args.resume)
             log.debug('Return code: {}, [Max process usage] {}'.format(retcode, max_obj))
 
         else:
-            taudem(args.huc, args.channel, args.dem, args.output_dir, args.mask, epsg, meta)
+            taudem(args.huc, args.channel, args.dem, args.output_dir, args.mask, epsg, meta, args.resume)
 
     except Exception as e:
         log.error(e)
@@ -0,0 +1,256 @@
+""" Testing for the VBET raster helpers
+
+"""
+import unittest
+import numpy as np
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from vbet import vbet_raster_ops
+from vbet.vbet_raster_ops import nodata_mask, iter_chunks, window_view, threshold_buffers, threshold_window, \
+    transform_evidence_inputs, combine_evidence
+
+NODATA = -9999.0
+
+
+def memory_raster(memfile: MemoryFile, array: np.ndarray, nodata, **kwargs):
+    """Write an array to an in-memory GeoTIFF and return it open for reading"""
+    profile = {'driver': 'GTiff', 'height': array.shape[0], 'width': array.shape[1], 'count': 1,
+               'dtype': array.dtype.name, 'nodata': nodata, 'transform': from_origin(0, array.shape[0], 1, 1)}
+    profile.update(kwargs)
+    with memfile.open(**profile) as dst:
+        dst.write(array, 1)
+    return memfile.open()
+
+
+class NodataMaskTest(unittest.TestCase):
+    """Boolean nodata masks against what rasterio's masked reads give
+    """
+
+    def test_value_nodata(self):
+        """Cells equal to the nodata value are masked
+        """
+        array = np.array([[1.0, NODATA], [NODATA, 0.0]], dtype=np.float32)
+        np.testing.assert_array_equal(nodata_mask(array, NODATA), [[False, True], [True, False]])
+
+    def test_nan_nodata(self):
+        """A NaN nodata value masks NaN cells, which never compare equal
+        """
+        array = np.array([[1.0, np.nan], [NODATA, 0.0]], dtype=np.float32)
+        np.testing.assert_array_equal(nodata_mask(array, float('nan')), [[False, True], [False, False]])
+
+    def test_no_nodata(self):
+        """Without a nodata value nothing is masked, including NaN
+        """
+        array = np.array([[1.0, np.nan]], dtype=np.float32)
+        np.testing.assert_array_equal(nodata_mask(array, None), [[False, False]])
+
+    def test_out_buffer(self):
+        """Masks written into a reused buffer are fully overwritten
+        """
+        buffer = np.ones(6, dtype=bool)
+        out = window_view(buffer, Window(0, 0, 2, 2))
+        mask = nodata_mask(np.array([[1, 0], [0, 1]], dtype=np.uint8), 0, out=out)
+        self.assertTrue(np.shares_memory(mask, buffer))
+        np.testing.assert_array_equal(mask, [[False, True], [True, False]])
+        np.testing.assert_array_equal(nodata_mask(np.zeros((2, 2), dtype=np.uint8), None, out=out), np.zeros((2, 2), dtype=bool))
+
+    def test_matches_rasterio(self):
+        """Same cells as a masked read
+        """
+        array = np.array([[1, 0, 3], [0, 5, 6]], dtype=np.int16)
+        with MemoryFile() as memfile, memory_raster(memfile, array, 0) as src:
+            np.testing.assert_array_equal(nodata_mask(src.read(1), src.nodata), src.read(1, masked=True).mask)
+
+
+class IterChunksTest(unittest.TestCase):
+    """Chunk windows cover the raster exactly once
+    """
+
+    def _coverage(self, src, **kwargs):
+        count = np.zeros(src.shape, dtype=np.uint8)
+        for window in iter_chunks(src, **kwargs):
+            count[window.toslices()] += 1
+        return count
+
+    def test_tiled(self):
+        """Tiled rasters are covered by chunks of whole blocks, edges clipped to the raster
+        """
+        array = np.zeros((100, 70), dtype=np.float32)
+        with MemoryFile() as memfile, memory_raster(memfile, array, NODATA, tiled=True, blockxsize=16, blockysize=16) as src:
+            windows = list(iter_chunks(src, chunk_blocks=2))
+            np.testing.assert_array_equal(self._coverage(src, chunk_blocks=2), 1)
+            for window in windows:
+                self.assertEqual(window.col_off % 32, 0)
+                self.assertEqual(window.row_off % 32, 0)
+
+    def test_striped(self):
+        """Striped rasters grow chunks down the raster up to about max_bytes
+        """
+        array = np.zeros((50, 10), dtype=np.float32)
+        with MemoryFile() as memfile, memory_raster(memfile, array, NODATA, blockysize=1) as src:
+            windows = list(iter_chunks(src, chunk_blocks=2, max_bytes=10 * 4 * 20))
+            np.testing.assert_array_equal(self._coverage(src, chunk_blocks=2, max_bytes=10 * 4 * 20), 1)
+            self.assertEqual([window.height for window in windows], [20, 20, 10])
+
+
+class ThresholdWindowTest(unittest.TestCase):
+    """Thresholding one window with nodata, NaN and mask raster handling
+    """
+
+    def setUp(self):
+        self.evidence = np.array([[0.9, 0.5, NODATA], [np.nan, 0.68, 0.7]], dtype=np.float32)
+        self.mask = np.array([[1, 1, 1], [1, 0, 1]], dtype=np.uint8)
+
+    def test_nodata_and_nan(self):
+        """Nodata and NaN cells never pass the threshold
+        """
+        with MemoryFile() as memfile, memory_raster(memfile, self.evidence, NODATA) as src:
+            out = threshold_window(src, Window(0, 0, 3, 2), 0.68)
+        self.assertEqual(out.dtype, np.uint8)
+        np.testing.assert_array_equal(out, [[1, 0, 0], [0, 1, 1]])
+
+    def test_mask_raster(self):
+        """Nodata cells of the mask raster are excluded
+        """
+        with MemoryFile() as memfile, memory_raster(memfile, self.evidence, NODATA) as src, \
+                MemoryFile() as mask_memfile, memory_raster(mask_memfile, self.mask, 0) as mask_src:
+            out = threshold_window(src, Window(0, 0, 3, 2), 0.68, mask_src)
+        np.testing.assert_array_equal(out, [[1, 0, 0], [0, 0, 1]])
+
+    def test_reused_buffers(self):
+        """Results with scratch buffers match fresh allocations for every window, edge windows included
+        """
+        rng = np.random.default_rng(1)
+        evidence = rng.random((37, 29), dtype=np.float32)
+        evidence[rng.random(evidence.shape) > 0.8] = NODATA
+        mask = (rng.random(evidence.shape) > 0.2).astype(np.uint8)
+        with MemoryFile() as memfile, memory_raster(memfile, evidence, NODATA, tiled=True, blockxsize=16, blockysize=16) as src, \
+                MemoryFile() as mask_memfile, memory_raster(mask_memfile, mask, 0, tiled=True, blockxsize=16, blockysize=16) as mask_src:
+            windows = [window for _ji, window in src.block_windows(1)]
+            buffers = threshold_buffers(windows, src, mask_src)
+            result = np.zeros(evidence.shape, dtype=np.uint8)
+            for window in windows:
+                out = threshold_window(src, window, 0.5, mask_src, buffers)
+                np.testing.assert_array_equal(out, threshold_window(src, window, 0.5, mask_src))
+                result[window.toslices()] = out
+        expected = (evidence >= 0.5) & (evidence != NODATA) & (mask != 0)
+        np.testing.assert_array_equal(result, expected.astype(np.uint8))
+
+
+class TransformEvidenceInputsTest(unittest.TestCase):
+    """Per-window transforms against the masked array calculation they replaced
+    """
+
+    def setUp(self):
+        self.hand = np.array([[0.5, 2.0, NODATA], [1.0, NODATA, 3.0]], dtype=np.float32)
+        self.slope = np.array([[1.0, NODATA, 4.0], [2.0, 8.0, 0.5]], dtype=np.float32)
+        self.prox = np.array([[0.0, 1.0, 4.0], [9.0, 16.0, 25.0]], dtype=np.float32)
+        self.max_prox = 25.0
+        self.block = {'HAND': self.hand, 'Slope': self.slope, 'Proximity': self.prox}
+        self.masks = {'HAND': self.hand == NODATA, 'Slope': self.slope == NODATA, 'Proximity': self.prox == NODATA}
+        self.slope_expr = '2.71828**(-0.12*a)'
+
+    def _transforms(self):
+        return {
+            'HAND': lambda a: a / 10.0,
+            'Slope': compile(self.slope_expr, '<Slope transform>', 'eval')
+        }
+
+    def test_slope_expression_with_proximity(self):
+        """The transformed slope takes the HAND mask as well as its own when proximity is used
+        """
+        transformed, masks = transform_evidence_inputs(dict(self.block), self.masks, self._transforms(),
+                                                       use_proximity=True, inv_sqrt_max_prox=1.0 / np.sqrt(self.max_prox))
+
+        # The masked array version this replaced
+        expected = np.ma.MaskedArray(eval(self.slope_expr, {'__builtins__': None}, {'a': self.slope}), mask=self.masks['Slope'])
+        expected = expected - np.sqrt(np.ma.MaskedArray(self.prox, mask=self.masks['HAND'])) / np.sqrt(self.max_prox)
+
+        np.testing.assert_array_equal(masks['Slope'], np.ma.getmaskarray(expected))
+        valid = ~masks['Slope']
+        np.testing.assert_allclose(transformed['Slope'][valid], expected.data[valid], rtol=1e-6)
+        self.assertEqual(transformed['Slope'].dtype, np.float32)
+
+    def test_slope_expression_without_proximity(self):
+        """Without proximity an expression transform keeps only its own input's mask
+        """
+        transformed, masks = transform_evidence_inputs(dict(self.block), self.masks, self._transforms())
+
+        np.testing.assert_array_equal(masks['Slope'], self.masks['Slope'])
+        expected = eval(self.slope_expr, {'__builtins__': None}, {'a': self.slope})
+        valid = ~masks['Slope']
+        np.testing.assert_allclose(transformed['Slope'][valid], expected[valid], rtol=1e-6)
+
+    def test_callable_transform_uses_hand_mask(self):
+        """Callable transforms are masked by HAND
+        """
+        transformed, masks = transform_evidence_inputs(dict(self.block), self.masks, self._transforms())
+
+        np.testing.assert_array_equal(masks['HAND'], self.masks['HAND'])
+        valid = ~masks['HAND']
+        np.testing.assert_allclose(transformed['HAND'][valid], self.hand[valid] / 10.0)
+
+
+class CombineEvidenceTest(unittest.TestCase):
+    """Topo and VBET evidence from one window of transformed inputs
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        shape = (64, 48)
+        self.hand = rng.random(shape, dtype=np.float32)
+        self.slope = rng.random(shape, dtype=np.float32) - np.float32(0.5)
+        self.slope[3, 5] = np.nan
+        self.channel = (rng.random(shape) > 0.7).astype(np.uint8)
+        self.hand_mask = rng.random(shape) > 0.9
+        self.slope_mask = rng.random(shape) > 0.9
+        self.channel_mask = rng.random(shape) > 0.95
+        self.shape = shape
+
+    def _run(self, combine):
+        topo = np.empty(self.shape, dtype=np.float32)
+        evidence = np.empty(self.shape, dtype=np.float32)
+        combine(self.hand, self.slope, self.channel, self.hand_mask, self.slope_mask, self.channel_mask,
+                np.float32(0.6), np.float32(0.4), vbet_raster_ops.CHANNEL_EVIDENCE_WEIGHT, np.float32(NODATA), topo, evidence)
+        return topo, evidence
+
+    def test_mask_propagation(self):
+        """HAND or slope nodata masks both outputs, channel nodata only masks the evidence
+        """
+        topo = np.empty(self.shape, dtype=np.float32)
+        evidence = np.empty(self.shape, dtype=np.float32)
+        combine_evidence(self.hand, self.slope, self.channel, self.hand_mask, self.slope_mask, self.channel_mask,
+                         0.6, 0.4, NODATA, topo, evidence)
+
+        topo_mask = self.hand_mask | self.slope_mask
+        np.testing.assert_array_equal(topo == NODATA, topo_mask)
+        np.testing.assert_array_equal(evidence == NODATA, topo_mask | self.channel_mask)
+
+        valid = ~(topo_mask | self.channel_mask) & ~np.isnan(self.slope)
+        expected_topo = np.float32(0.6) * self.hand + np.float32(0.4) * self.slope
+        np.testing.assert_allclose(topo[valid], expected_topo[valid], rtol=1e-6)
+        np.testing.assert_allclose(evidence[valid], np.maximum(expected_topo, 0.995 * self.channel)[valid], rtol=1e-6)
+
+    def test_nan_propagation(self):
+        """A NaN slope gives NaN topo and evidence, even on the channel
+        """
+        self.channel[3, 5] = 1
+        for mask in [self.hand_mask, self.slope_mask, self.channel_mask]:
+            mask[3, 5] = False
+        topo, evidence = self._run(vbet_raster_ops._combine_evidence_numpy)
+        self.assertTrue(np.isnan(topo[3, 5]))
+        self.assertTrue(np.isnan(evidence[3, 5]))
+
+    @unittest.skipIf(vbet_raster_ops._combine_evidence_kernel is None, 'Numba is not installed')
+    def test_numba_matches_numpy(self):
+        """The Numba kernel and the numpy fallback give identical results
+        """
+        topo_np, evidence_np = self._run(vbet_raster_ops._combine_evidence_numpy)
+        topo_nb, evidence_nb = self._run(vbet_raster_ops._combine_evidence_kernel)
+        np.testing.assert_array_equal(topo_nb, topo_np)
+        np.testing.assert_array_equal(evidence_nb, evidence_np)
+
+
+if __name__ == '__main__':
+    unittest.main()
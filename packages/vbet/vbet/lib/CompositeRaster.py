@@ -7,10 +7,8 @@ That is just tedious enough that it deservers its own class
 import os
 from typing import List
 from osgeo import gdal
-import rasterio
 from rscommons.util import safe_makedirs
 from rscommons import Logger, Timer, ProgressBar
-from vbet.vbet_raster_ops import get_raster_meta
 
 
 class CompositeRaster(object):
@@ -56,16 +54,17 @@ class CompositeRaster(object):
 
         """
         _tmr = Timer()
-        # This will add compresssion parameters
-        meta = get_raster_meta(self.vrt_path)
+        # One GDAL pass resolves the mosaic in C and compresses on every core,
+        # instead of copying the VRT through Python a window at a time
+        progbar = ProgressBar(100, 50, f"Transcribing VRT {self.vrt_path}")
 
-        with rasterio.open(self.vrt_path, 'r') as src, rasterio.open(self.out_path, 'w', **meta) as dst:
-            _prg = ProgressBar(len(list(src.block_windows(1))), 50, f"Transcribing VRT {self.vrt_path}")
-            counter = 0
-            for _ji, window in src.block_windows(1):
-                _prg.update(counter)
-                counter += 1
-                array_dest = src.read(1, window=window, masked=True)
-                dst.write(array_dest, window=window, indexes=1)
-            _prg.finish()
+        def translate_progress(progress, _msg, _data):
+            progbar.update(int(progress * 100))
+
+        translate_options = gdal.TranslateOptions(
+            format='GTiff',
+            creationOptions=['COMPRESS=DEFLATE', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER'],
+            callback=translate_progress)
+        gdal.Translate(self.out_path, self.vrt_path, options=translate_options)
+        progbar.finish()
         self.log.info(f'Composite built for "{self.out_path}" in: {_tmr.toString()}')
@@ -16,10 +16,13 @@ import traceback
 import sqlite3
 import shutil
 from copy import deepcopy
+from functools import wraps
+from types import CodeType
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 from math import ceil
 
-from osgeo import ogr
+from osgeo import ogr, gdal, osr
 import rasterio
 from rasterio.windows import Window
 from shapely.geometry import box
@@ -27,7 +30,7 @@ import numpy as np
 
 from rscommons import RSProject, RSLayer, ModelConfig, ProgressBar, Logger, GeopackageLayer, dotenv, VectorBase, initGDALOGRErrors
 from rscommons.vector_ops import copy_feature_class, polygonize, difference, collect_linestring, collect_feature_class
-from rscommons.geometry_ops import get_extent_as_geom, get_rectangle_as_geom
+from rscommons.geometry_ops import get_rectangle_as_geom
 from rscommons.util import safe_makedirs, parse_metadata, pretty_duration, safe_remove_dir
 from rscommons.hand import run_subprocess
 from rscommons.vbet_network import get_channel_level_path, get_distance_lookup, vbet_network
@@ -37,7 +40,7 @@ from rscommons import TimerBuckets, TimerWaypoints
 from rscommons.augment_lyr_meta import augment_layermeta, add_layer_descriptions, raster_resolution_meta
 
 from vbet.vbet_database import build_vbet_database, load_configuration
-from vbet.vbet_raster_ops import rasterize, raster_logic_mask, raster_update_multiply, raster_remove_zone, get_endpoints_on_raster, generate_vbet_polygon, generate_centerline_surface, clean_raster_regions, proximity_raster
+from vbet.vbet_raster_ops import SCRATCH_COMPRESSION, rasterize, nodata_mask, iter_chunks, window_view, transform_evidence_inputs, combine_evidence, raster_logic_mask, raster_update_multiply, raster_remove_zone, get_endpoints_on_raster, generate_vbet_polygon, generate_centerline_surface, clean_raster_regions, proximity_raster
 from vbet.vbet_outputs import clean_up_centerlines
 from vbet.vbet_report import VBETReport
 from vbet.vbet_segmentation import calculate_dgo_metrics, generate_igo_points, split_vbet_polygons, calculate_vbet_window_metrics, add_fcodes
@@ -52,6 +55,8 @@ Path = str
 # "8"
 NCORES = os.environ['TAUDEM_CORES'] if 'TAUDEM_CORES' in os.environ else '2'
 BIG_TIFF_THRESH = 3800000000
+# GDAL block cache for the warps, rasterizations and composites (MB)
+GDAL_CACHE_MB = int(os.environ['VBET_GDAL_CACHE_MB']) if 'VBET_GDAL_CACHE_MB' in os.environ else 2048
 initGDALOGRErrors()
 
 cfg = ModelConfig(
@@ -108,6 +113,23 @@ LayerTypes = {
 }
 
 
+def restore_gdal_config(func):
+    """Put the process-wide GDAL settings vbet changes back the way they were when func finishes"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        prev_readdir = gdal.GetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN')
+        prev_num_threads = gdal.GetConfigOption('GDAL_NUM_THREADS')
+        prev_cache_max = gdal.GetCacheMax()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', prev_readdir)
+            gdal.SetConfigOption('GDAL_NUM_THREADS', prev_num_threads)
+            gdal.SetCacheMax(prev_cache_max)
+    return wrapper
+
+
+@restore_gdal_config
 def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, project_folder, huc, flowline_type='NHD',
          unique_stream_field='level_path', unique_reach_field='NHDPlusID', drain_area_field='DivDASqKm',
          level_paths=None, in_pitfill_dem=None, in_dinfflowdir_ang=None, in_dinfflowdir_slp=None, meta=None, debug=False,
@@ -119,6 +141,13 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
     log = Logger('VBET')
     log.info(f'Starting VBET v.{cfg.version}')
 
+    # VBET opens a lot of rasters that sit in folders full of other level path rasters. Don't let
+    # GDAL list those folders on every open, and give it a block cache and threads that suit
+    # HUC sized rasters. restore_gdal_config puts them back when we're done
+    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+    gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+    gdal.SetCacheMax(GDAL_CACHE_MB * 1024 * 1024)
+
     # This could be a re-run and we need to clear out the tmp folders
     if os.path.isdir(temp_folder):
         safe_remove_dir(temp_folder)
@@ -134,9 +163,23 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
         safe_remove_dir(outputs_dir)
     safe_makedirs(outputs_dir)
 
-    with rasterio.open(in_dem) as dem_src:
+    # Open the input rasters once and keep what we need from them for the rest of the run
+    with rasterio.open(in_dem) as dem_src, rasterio.open(in_slope) as slope_src, rasterio.open(in_hillshade) as hillshade_src:
         if dem_src.crs != cfg.OUTPUT_EPSG:
             cfg.OUTPUT_EPSG = dem_src.crs
+        # check that rasters have same crs
+        dem_crs = dem_src.crs
+        if dem_src.crs != slope_src.crs or dem_src.crs != hillshade_src.crs:
+            raise Exception(
+                'DEM, slope, and hillshade rasters must have the same projection.')
+        raster_bounds = dem_src.bounds
+        dem_srs = osr.SpatialReference()
+        dem_srs.ImportFromWkt(dem_src.crs.to_wkt())
+        slope_meta = slope_src.meta
+        size_x = slope_src.width
+        size_y = slope_src.height
+        pixel_x, _pixel_y = slope_src.res
+        srs = slope_src.crs
 
     project_name = f'VBET for HUC {huc}'
     project = RSProject(cfg, project_folder)
@@ -184,18 +227,17 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
                        epsg=cfg.OUTPUT_EPSG, clip_shape=clip_mask)
 
     lp_fcodes = {}  # if its only canal and art path, the level path will get removed from the run
-    lps_to_remove = []
-    with GeopackageLayer(tmp_line_network) as lyr:
-        for feat, *_ in lyr.iterate_features():
-            if feat.GetField(unique_stream_field) not in lp_fcodes:
-                lp_fcodes[feat.GetField(unique_stream_field)] = [feat.GetField('FCode')]
-            else:
-                if feat.GetField('FCode') not in lp_fcodes[feat.GetField(unique_stream_field)]:
-                    lp_fcodes[feat.GetField(unique_stream_field)].append(feat.GetField('FCode'))
+    lps_to_remove = set()
+    # Let SQLite find the distinct level path / FCode pairs instead of visiting every flowline
+    with sqlite3.connect(os.path.dirname(tmp_line_network)) as conn:
+        lp_fcode_rows = conn.execute(
+            f"SELECT DISTINCT {unique_stream_field}, FCode FROM {os.path.basename(tmp_line_network)}").fetchall()
+    for lp, fcode in lp_fcode_rows:
+        lp_fcodes.setdefault(lp, set()).add(fcode)
     for lp, fcs in lp_fcodes.items():
-        if fcs == [33600, 55800] or fcs == [55800, 33600]:
+        if fcs == {33600, 55800}:
             if lp is not None:
-                lps_to_remove.append(str(int(lp)))
+                lps_to_remove.add(str(int(lp)))
 
     vbet_network(tmp_line_network, None, line_network, epsg=cfg.OUTPUT_EPSG,
                  fcodes=reach_codes, hard_clip_shape=clip_mask)
@@ -209,19 +251,17 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
     log.info('Building VBET Database')
     build_vbet_database(inputs_gpkg)
     vbet_run = load_configuration(inputs_gpkg)
+    # Function transforms are python expressions. Parse them once for the whole run instead of
+    # once per level path (or worse, once per window)
+    run_transforms = {name: [compile(transform, f'<{name} transform>', 'eval') if isinstance(transform, str) else transform
+                             for transform in transforms]
+                      for name, transforms in vbet_run['Transforms'].items()}
 
     get_channel_level_path(channel_area, line_network,
                            unique_stream_field, unique_reach_field)
 
     in_rasters = {}
 
-    # check that rasters have same crs
-    with rasterio.open(in_dem) as dem_src, rasterio.open(in_slope) as slope_src, rasterio.open(in_hillshade) as hillshade_src:
-        dem_crs = dem_src.crs
-        if dem_src.crs != slope_src.crs or dem_src.crs != hillshade_src.crs:
-            raise Exception(
-                'DEM, slope, and hillshade rasters must have the same projection.')
-
     _proj_hillshade_node, _hillshade = project.add_project_raster(
         proj_nodes['Inputs'], LayerTypes['HILLSHADE'], in_hillshade, replace=True)
     _proj_dem_node, dem = project.add_project_raster(
@@ -277,16 +317,10 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
             proj_nodes['Intermediates'], LayerTypes['DINFFLOWDIR_SLP'], in_dinfflowdir_slp, replace=True)
 
     log.info('Writing Topo Evidence raster for project')
-    read_rasters = {name: rasterio.open(raster)
-                    for name, raster in in_rasters.items()}
-    out_meta = read_rasters['Slope'].meta
+    out_meta = slope_meta
     out_meta['driver'] = 'GTiff'
     out_meta['count'] = 1
     out_meta['compress'] = 'deflate'
-    size_x = read_rasters['Slope'].width
-    size_y = read_rasters['Slope'].height
-    pixel_x, _pixel_y = read_rasters['Slope'].res
-    srs = read_rasters['Slope'].crs
     espg = srs.to_epsg()
 
     empty_array = np.empty((size_x, size_y), dtype=np.int32)
@@ -392,12 +426,10 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
             level_paths_to_run = all_level_paths
         all_level_paths = None
 
-    for lp in level_paths_to_run:
-        if lp in lps_to_remove:
-            level_paths_to_run.remove(lp)
+    level_paths_to_run = [lp for lp in level_paths_to_run if lp not in lps_to_remove]
 
-        # level_path_stream_order = dict([(str(int(row[0])), row[1]) for row in curs.execute("SELECT LevelPathI, MAX(StreamOrde) FROM NHDPlusFlowlineVAA GROUP BY LevelPathI ").fetchall()])
-        # level_path_stream_order[None] = 1
+    # level_path_stream_order = dict([(str(int(row[0])), row[1]) for row in curs.execute("SELECT LevelPathI, MAX(StreamOrde) FROM NHDPlusFlowlineVAA GROUP BY LevelPathI ").fetchall()])
+    # level_path_stream_order[None] = 1
 
     # process all polygons that aren't assigned a level path: ponds, waterbodies etc.
     if flowline_type == 'NHD':
@@ -406,12 +438,10 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
     project.add_project_geopackage(proj_nodes['Inputs'], LayerTypes['INPUTS'])
 
     # Generate max extent based on dem size
-    with rasterio.open(dem) as raster:
-        raster_bounds = raster.bounds
     bbox = box(*raster_bounds)
     raster_envelope_geom = VectorBase.shapely2ogr(bbox)
-    vbet_clip_buffer_size = VectorBase.rough_convert_metres_to_raster_units(
-        dem, 0.25)
+    vbet_clip_buffer_size = VectorBase.rough_convert_metres_to_spatial_ref_units(
+        dem_srs, (raster_bounds.left, raster_bounds.right, raster_bounds.bottom, raster_bounds.top), 0.25)
 
     _tmr_waypt.timer_break('InputPrep')  # this is where input prep ends
 
@@ -507,12 +537,16 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
                     continue
 
                 with GeopackageLayer(line_network) as lyr_lines:
-                    geom_envelope = channel_envelope_geom.Clone()
+                    # The processing extent is the bounding box of the channel and every flowline that
+                    # crosses it, so grow the box numerically rather than unioning rectangles in GEOS
+                    min_x, max_x, min_y, max_y = channel_bbox
                     for feat_line, *_ in lyr_lines.iterate_features(clip_shape=channel_envelope_geom):
-                        geom_line = feat_line.GetGeometryRef()
-                        geom_line_envelope = get_extent_as_geom(geom_line)
-                        geom_envelope = geom_envelope.Union(geom_line_envelope)
-                        geom_envelope = get_extent_as_geom(geom_envelope)
+                        line_min_x, line_max_x, line_min_y, line_max_y = feat_line.GetGeometryRef().GetEnvelope()
+                        min_x = min(min_x, line_min_x)
+                        max_x = max(max_x, line_max_x)
+                        min_y = min(min_y, line_min_y)
+                        max_y = max(max_y, line_max_y)
+                    geom_envelope = get_rectangle_as_geom((min_x, max_x, min_y, max_y))
 
             with TimerBuckets('ogr'):
                 geom_channel_buffer = geom_envelope.Buffer(channel_buffer_size)
@@ -561,6 +595,15 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
         with TimerBuckets('rasterize'):
             rasterize(level_path_polygons, rasterized_channel,
                       local_pitfill_dem, all_touched=True)
+            # A channel that burns no cells (e.g. polygons entirely off the DEM) would give TauDEM
+            # nothing to measure HAND from, so don't spend the dinfdistdown run on it
+            with rasterio.open(rasterized_channel) as channel_src:
+                has_channel = any(np.any(channel_src.read(1, window=window) > 0) for window in iter_chunks(channel_src))
+            if not has_channel:
+                err_msg = f"Channel area for Level Path {level_path} does not cover any DEM cells."
+                log.warning(err_msg)
+                _tmterr("EMPTY_CHANNEL_RASTER", err_msg)
+                continue
             in_rasters['Channel'] = rasterized_channel
             # distance weighting for Slope evidence
             proximity_raster(rasterized_channel, prox_raster_path)
@@ -626,7 +669,9 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
             out_meta = read_rasters['HAND'].meta
             out_meta['driver'] = 'GTiff'
             out_meta['count'] = 1
-            out_meta['compress'] = 'deflate'
+            # These only live until the composites are built. Tile them to match the chunked reads
+            out_meta.update(SCRATCH_COMPRESSION)
+            out_meta.update({'predictor': 3, 'tiled': True, 'blockxsize': 512, 'blockysize': 512})
 
             use_big_tiff_interior = os.path.getsize(
                 in_rasters['HAND']) > BIG_TIFF_THRESH
@@ -657,8 +702,8 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
             write_rasters['topo_evidence'] = rasterio.open(os.path.join(
                 temp_folder_lpath, f'topo_evidence_{level_path}.tif'), 'w', **out_meta)
 
-            progbar = ProgressBar(len(
-                list(read_rasters['Slope'].block_windows(1))), 50, "Calculating evidence layer")
+            windows = list(iter_chunks(read_rasters['HAND']))
+            progbar = ProgressBar(len(windows), 50, "Calculating evidence layer")
             counter = 0
             # Again, these rasters should be orthogonal so their windows should also line up
             in_transform = read_rasters['HAND'].get_transform()
@@ -671,67 +716,102 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
                 log.warning('Slope raster is smaller than the HAND raster. Adjusting col_off_delta.')
                 col_off_delta = col_off_delta - (read_rasters['HAND'].width - (read_rasters['Slope'].width-col_off_delta))
 
-            for _ji, window in read_rasters['HAND'].block_windows(1):
-                progbar.update(counter)
-                counter += 1
-                modified_window = Window(
-                    window.col_off + col_off_delta, window.row_off + row_off_delta, window.width, window.height)
-                block = {}
-                for block_name, raster in read_rasters.items():
-                    out_window = window if block_name in [
-                        'HAND', 'Channel', 'TRANSFORM_ZONE_HAND', 'Proximity'] else modified_window
-                    block[block_name] = raster.read(
-                        1, window=out_window, masked=True)
-
-                transformed = {}
-                for name in vbet_run['Inputs']:
-                    if name in vbet_run['Zones']:
-                        zone = get_zone(
-                            vbet_run, name, level_paths_drainage[level_path])
-                        transform = vbet_run['Transforms'][name][zone]
-                        if isinstance(transform, str):
-                            locs = {'a': block[name].data}
-                            with warnings.catch_warnings(record=True) as w:
-                                warnings.simplefilter("always")
-                                trans_ds = eval(
-                                    transform, {'__builtins__': None}, locs)
-                                if w and issubclass(w[-1].category, RuntimeWarning):
-                                    pass
-                            transformed[name] = np.ma.MaskedArray(
-                                trans_ds, mask=block[name].mask)
-
+            # Resolve the transform for each input once per level path instead of once per window
+            input_transforms = {}
+            slope_zone = None
+            for name in vbet_run['Inputs']:
+                if name in vbet_run['Zones']:
+                    zone = get_zone(vbet_run, name, level_paths_drainage[level_path])
+                    input_transforms[name] = run_transforms[name][zone]
+                    if name == 'Slope':
+                        slope_zone = zone
+                else:
+                    input_transforms[name] = run_transforms[name][0]
+
+            nodata = out_meta['nodata']
+            hand_weight = vbet_run['Inputs']['HAND']['weight']
+            slope_weight = vbet_run['Inputs']['Slope']['weight']
+            # Multiply by the reciprocal rather than dividing every pixel of every window
+            inv_sqrt_max_prox = np.float32(1.0 / np.sqrt(max_prox))
+
+            # Proximity only feeds the slope weighting for the smaller stream zones, so don't read it otherwise
+            use_proximity = slope_zone is not None and slope_zone < 3
+            evidence_inputs = {name: raster for name, raster in read_rasters.items() if use_proximity or name != 'Proximity'}
+
+            # Scratch buffers sized to the largest window and reused for every window
+            buf_size = max(window.height * window.width for window in windows)
+            read_buffers = {name: np.empty(buf_size, dtype=raster.dtypes[0]) for name, raster in evidence_inputs.items()}
+            topo_buffer = np.empty(buf_size, dtype=np.float32)
+            evidence_buffer = np.empty(buf_size, dtype=np.float32)
+            prox_buffer = np.empty(buf_size, dtype=np.float32)
+            slope_mask_buffer = np.empty(buf_size, dtype=bool)
+            # Only the inputs that feed the evidence need nodata masks. Look their nodata values up once
+            mask_nodata = {name: read_rasters[name].nodata for name in set(input_transforms) | {'HAND', 'Channel'}}
+            mask_buffers = {name: np.empty(buf_size, dtype=bool) for name in mask_nodata}
+            # Windows with no HAND at all have nodata topo, evidence and transformed HAND. Expression
+            # transforms are masked by their own input though, so without proximity (which carries the
+            # HAND mask) the transformed slope can still have values there
+            slope_outside_hand = isinstance(input_transforms['Slope'], CodeType) and not use_proximity
+            empty_window_inputs = {name: raster for name, raster in evidence_inputs.items()
+                                   if slope_outside_hand and name == 'Slope'}
+            empty_window_transforms = {'Slope': input_transforms['Slope']} if slope_outside_hand else {}
+
+            with ThreadPoolExecutor(max_workers=len(write_rasters)) as write_pool:
+                for window in windows:
+                    progbar.update(counter)
+                    counter += 1
+                    modified_window = Window(
+                        window.col_off + col_off_delta, window.row_off + row_off_delta, window.width, window.height)
+                    # Plain reads plus boolean nodata masks. Masked arrays allocate a mask for every
+                    # intermediate result, which dominated this loop on large rasters.
+                    block = {'HAND': read_rasters['HAND'].read(1, window=window, out=window_view(read_buffers['HAND'], window))}
+                    hand_mask = nodata_mask(block['HAND'], mask_nodata['HAND'], out=window_view(mask_buffers['HAND'], window))
+                    hand_empty = hand_mask.all()
+                    window_inputs = empty_window_inputs if hand_empty else evidence_inputs
+                    window_transforms = empty_window_transforms if hand_empty else input_transforms
+                    for block_name, raster in window_inputs.items():
+                        if block_name == 'HAND':
+                            continue
+                        out_window = window if block_name in [
+                            'HAND', 'Channel', 'TRANSFORM_ZONE_HAND', 'Proximity'] else modified_window
+                        block[block_name] = raster.read(1, window=out_window, out=window_view(read_buffers[block_name], window))
+                    masks = {name: nodata_mask(block[name], value, out=window_view(mask_buffers[name], window))
+                             for name, value in mask_nodata.items() if name in block and name != 'HAND'}
+                    masks['HAND'] = hand_mask
+
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore")
+                        transformed, transformed_masks = transform_evidence_inputs(
+                            block, masks, window_transforms, use_proximity, inv_sqrt_max_prox,
+                            prox_out=window_view(prox_buffer, window), slope_mask_out=window_view(slope_mask_buffer, window))
+
+                        fvals_topo = window_view(topo_buffer, window)
+                        fvals_evidence = window_view(evidence_buffer, window)
+                        if hand_empty:
+                            fvals_topo.fill(nodata)
+                            fvals_evidence = fvals_topo
+                            transformed['HAND'] = fvals_topo
+                            transformed_masks['HAND'] = masks['HAND']
+                            if 'Slope' not in transformed:
+                                transformed['Slope'] = fvals_topo
+                                transformed_masks['Slope'] = masks['HAND']
                         else:
-                            transformed[name] = np.ma.MaskedArray(
-                                transform(block[name].data), mask=block['HAND'].mask)
-                    else:
-                        transformed[name] = np.ma.MaskedArray(
-                            vbet_run['Transforms'][name][0](block[name].data), mask=block['HAND'].mask)
-
-                    masked_prox = np.ma.MaskedArray(
-                        block['Proximity'].data, mask=block['HAND'].mask)
-                    if name == 'Slope' and zone < 3:
-                        with warnings.catch_warnings(record=True) as w:
-                            warnings.simplefilter("always")
-                            # transformed[name] = transformed[name] - ((np.log(masked_prox + 0.1) + 2.303) / np.log(max_prox + 2.303))
-                            transformed[name] = transformed[name] - \
-                                (np.sqrt(masked_prox) / np.sqrt(max_prox))
-                            if w and issubclass(w[-1].category, RuntimeWarning):
-                                pass
-
-                fvals_topo = vbet_run['Inputs']['HAND']['weight'] * transformed['HAND'] + \
-                    vbet_run['Inputs']['Slope']['weight'] * \
-                    transformed['Slope']
-                fvals_channel = 0.995 * block['Channel']
-                fvals_evidence = np.maximum(fvals_topo, fvals_channel)
-
-                write_rasters['topo_evidence'].write(np.ma.filled(np.float32(
-                    fvals_topo), out_meta['nodata']), window=window, indexes=1)
-                write_rasters['VBET_EVIDENCE'].write(np.ma.filled(np.float32(
-                    fvals_evidence), out_meta['nodata']), window=window, indexes=1)
-                write_rasters['TRANSFORMED_HAND'].write(np.ma.filled(np.float32(
-                    transformed['HAND']), out_meta['nodata']), window=window, indexes=1)
-                write_rasters['TRANSFORMED_SLOPE'].write(np.ma.filled(np.float32(
-                    transformed['Slope']), out_meta['nodata']), window=window, indexes=1)
+                            combine_evidence(transformed['HAND'], transformed['Slope'], block['Channel'],
+                                             transformed_masks['HAND'], transformed_masks['Slope'], masks['Channel'],
+                                             hand_weight, slope_weight, nodata, fvals_topo, fvals_evidence)
+
+                    for name in ['HAND', 'Slope']:
+                        transformed[name][transformed_masks[name]] = nodata
+
+                    # Each output compresses and writes on its own thread. Wait for them before the
+                    # next window since the buffers get reused
+                    writes = [write_pool.submit(write_rasters[out_name].write, out_arr, window=window, indexes=1)
+                              for out_name, out_arr in [('topo_evidence', fvals_topo),
+                                                        ('VBET_EVIDENCE', fvals_evidence),
+                                                        ('TRANSFORMED_HAND', transformed['HAND']),
+                                                        ('TRANSFORMED_SLOPE', transformed['Slope'])]]
+                    for write in writes:
+                        write.result()
             write_rasters['VBET_EVIDENCE'].close()
             write_rasters['TRANSFORMED_HAND'].close()
             write_rasters['TRANSFORMED_SLOPE'].close()
@@ -782,19 +862,14 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
                     if use_big_tiff_cline:
                         out_meta['BIGTIFF'] = 'YES'
 
-                    out_meta['compress'] = 'deflate'
+                    out_meta.update(SCRATCH_COMPRESSION)
                     with rasterio.open(valley_bottom_flowline_raster, 'w', **out_meta) as rio_out:
                         for _ji, window in rio_vbet.block_windows(1):
-                            array_vbet = np.ma.MaskedArray(
-                                rio_vbet.read(1, window=window).data)
-                            array_flowline = np.ma.MaskedArray(
-                                rio_flowline.read(1, window=window).data)
+                            array_vbet = rio_vbet.read(1, window=window)
+                            array_flowline = rio_flowline.read(1, window=window)
                             array_logic = array_vbet + array_flowline
                             array_out = np.greater_equal(array_logic, 1)
-                            array_out_format = array_out if out_meta['dtype'] == 'int32' else np.float32(
-                                array_out)
-                            rio_out.write(np.ma.filled(
-                                array_out_format, out_meta['nodata']), window=window, indexes=1)
+                            rio_out.write(array_out.astype(out_meta['dtype']), window=window, indexes=1)
 
                 # Generate Centerline from Cost Path
                 log.info('Generating Centerline from cost path')
@@ -854,15 +929,13 @@ def vbet(in_line_network, in_dem, in_slope, in_hillshade, in_channel_area, proje
                     lyr_cl.ogr_layer.CreateFeature(out_feature)
                     out_feature = None
 
-        # Mask the raster and create the inner versions of itself
-        raster_logic_mask(hand_raster, hand_raster_interior,
-                          valley_bottom_raster)
-        raster_logic_mask(transformed_hand,
-                          transformed_hand_interior, valley_bottom_raster)
-        raster_logic_mask(
-            evidence_raster, evidence_raster_interior, valley_bottom_raster)
-        raster_logic_mask(transformed_slope,
-                          transformed_slope_interior, valley_bottom_raster)
+        # Mask the raster and create the inner versions of itself. The four are independent and
+        # rasterio releases the GIL while it reads and writes, so run them side by side
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(raster_logic_mask,
+                              [hand_raster, transformed_hand, evidence_raster, transformed_slope],
+                              [hand_raster_interior, transformed_hand_interior, evidence_raster_interior, transformed_slope_interior],
+                              [valley_bottom_raster] * 4))
 
         # Add these to arrays so that we can use them later
         if os.path.isfile(hand_raster):
@@ -1185,6 +1258,46 @@ def get_zone(run, zone_type, drain_area):
             return zone
 
 
+def _split_csv(value: str, sentinel: str = '.'):
+    """Split a comma separated argument, dropping empty items
+
+    Args:
+        value (str): comma separated string
+        sentinel (str, optional): value that means "no filter". Defaults to '.'.
+
+    Returns:
+        list: list of values or None if the argument is empty or the sentinel
+    """
+    if not value or value == sentinel:
+        return None
+    return [item for item in value.split(',') if item] or None
+
+
+def _validate_inputs(args) -> str:
+    """Cheap checks on the command line arguments so bad runs fail before any work starts
+
+    Args:
+        args (argparse.Namespace): parsed arguments
+
+    Returns:
+        str: description of the first problem found or None if everything checks out
+    """
+    if not (args.huc.isdigit() and len(args.huc) % 2 == 0 and 2 <= len(args.huc) <= 12):
+        return f'huc must be a 2 to 12 digit hydrologic unit code: {args.huc}'
+
+    rasters = [args.dem, args.slope, args.hillshade, args.pitfill, args.dinfflowdir_ang, args.dinfflowdir_slp]
+    for raster_path in rasters:
+        if raster_path is not None and not os.path.isfile(raster_path):
+            return f'Raster not found: {raster_path}'
+
+    # Vector inputs can be compound geopackage/layer paths
+    for vector_path in [args.flowline_network, args.channel_area, args.mask]:
+        if vector_path is not None and not os.path.exists(VectorBase.path_sorter(vector_path)[0]):
+            return f'Vector dataset not found: {vector_path}'
+
+    return None
+
+
 def main():
     """_summary_
     """
@@ -1201,18 +1314,18 @@ def main():
     parser.add_argument('channel_area', type=str)
     parser.add_argument(
         'output_dir', help='Folder where output VBET project will be created', type=str)
-    parser.add_argument('flowline_type', type=str, default='NHD')
-    parser.add_argument('unique_stream_field', type=str, default='level_path')
-    parser.add_argument('unique_reach_field', type=str, default='NHDPlusID')
-    parser.add_argument('drain_area_field', type=str, default='DivDASqKm')
+    parser.add_argument('flowline_type', type=str, nargs='?', default='NHD')
+    parser.add_argument('unique_stream_field', type=str, nargs='?', default='level_path')
+    parser.add_argument('unique_reach_field', type=str, nargs='?', default='NHDPlusID')
+    parser.add_argument('drain_area_field', type=str, nargs='?', default='DivDASqKm')
     parser.add_argument(
         '--level_paths', help='csv list of level paths', type=str, default="")
     parser.add_argument(
-        '--pitfill', help='riverscapes project metadata as comma separated key=value pairs', default=None)
+        '--pitfill', help='(optional) existing TauDEM pitfill raster', default=None)
     parser.add_argument('--dinfflowdir_ang',
-                        help='(optional) a little extra logging ', default=None)
+                        help='(optional) existing TauDEM D-Inf flow direction raster', default=None)
     parser.add_argument(
-        '--dinfflowdir_slp', help='Add debug tools for tracing things like memory usage at a performance cost.', default=None)
+        '--dinfflowdir_slp', help='(optional) existing TauDEM D-Inf flow direction slope raster', default=None)
     parser.add_argument(
         '--reach_codes', help='Comma delimited reach codes (FCode) to retain when filtering features. Omitting this option retains all features.', type=str)
     parser.add_argument(
@@ -1224,8 +1337,16 @@ def main():
                         action='store_true', default=False)
     parser.add_argument('--debug', help='Add debug tools for tracing things like memory usage at a performance cost.',
                         action='store_true', default=False)
+    parser.add_argument('--debug_sample_interval', help='(optional) seconds between --debug memory samples',
+                        type=float, default=1.0)
     args = dotenv.parse_args_env(parser)
 
+    # Fail fast on bad inputs before any output folder or log file is created.
+    # This happens after parse_args_env so that {env:NAME} paths are resolved.
+    input_error = _validate_inputs(args)
+    if input_error is not None:
+        parser.error(input_error)
+
     # make sure the output folder exists
     safe_makedirs(args.output_dir)
 
@@ -1236,36 +1357,38 @@ def main():
     log.title(f'Riverscapes VBET For HUC: {args.huc}')
 
     meta = parse_metadata(args.meta)
-    reach_codes = args.reach_codes.split(',') if args.reach_codes else None
-    level_paths = args.level_paths.split(',')
-    level_paths = level_paths if level_paths != ['.'] else None
+    reach_codes = _split_csv(args.reach_codes)
+    level_paths = _split_csv(args.level_paths)
 
     # Allow us to specify a temp folder outside our project folder
     temp_folder = args.temp_folder if args.temp_folder else os.path.join(
         args.output_dir, 'temp')
 
+    # Build the call once so the debug and normal paths can't drift apart
+    vbet_args = [
+        args.flowline_network, args.dem, args.slope, args.hillshade, args.channel_area, args.output_dir,
+        args.huc, args.flowline_type, args.unique_stream_field, args.unique_reach_field, args.drain_area_field, level_paths,
+        args.pitfill, args.dinfflowdir_ang, args.dinfflowdir_slp
+    ]
+    vbet_kwargs = {
+        'meta': meta,
+        'reach_codes': reach_codes,
+        'mask': args.mask,
+        'debug': args.debug,
+        'temp_folder': temp_folder
+    }
+
     try:
         if args.debug is True:
             # pylint: disable=import-outside-toplevel
             from rscommons.debug import ThreadRun
             memfile = os.path.join(args.output_dir, 'vbet_mem.log')
-            retcode, max_obj = ThreadRun(
-                vbet, memfile,
-                args.flowline_network, args.dem, args.slope, args.hillshade, args.channel_area, args.output_dir,
-                args.huc, args.flowline_type, args.unique_stream_field, args.unique_reach_field, args.drain_area_field, level_paths,
-                args.pitfill, args.dinfflowdir_ang, args.dinfflowdir_slp, meta=meta, reach_codes=reach_codes, mask=args.mask,
-                debug=args.debug, temp_folder=temp_folder
-            )
+            retcode, max_obj = ThreadRun(vbet, memfile, *vbet_args, sample_interval=args.debug_sample_interval, **vbet_kwargs)
             log.debug(f'Return code: {retcode}, [Max process usage] {max_obj}')
             # Zip up a copy of the temp folder for debugging purposes
             zip_temp_folder(temp_folder, os.path.join(args.output_dir, 'temp'))
         else:
-            vbet(
-                args.flowline_network, args.dem, args.slope, args.hillshade, args.channel_area, args.output_dir,
-                args.huc, args.flowline_type, args.unique_stream_field, args.unique_reach_field, args.drain_area_field, level_paths,
-                args.pitfill, args.dinfflowdir_ang, args.dinfflowdir_slp, meta=meta, reach_codes=reach_codes, mask=args.mask,
-                debug=args.debug, temp_folder=args.temp_folder
-            )
+            vbet(*vbet_args, **vbet_kwargs)
 
         safe_remove_dir(temp_folder)
     except Exception as err:
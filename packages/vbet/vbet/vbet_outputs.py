@@ -6,14 +6,38 @@
 """
 
 from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
 from osgeo import ogr
+from shapely.strtree import STRtree
+from shapely.wkb import loads as wkbload
 
-from rscommons import Logger, GeopackageLayer, TempGeopackage, get_shp_or_gpkg, Timer
+from rscommons import Logger, GeopackageLayer, TempGeopackage, get_shp_or_gpkg, Timer, ProgressBar
 from vbet.__version__ import __version__
 
 Path = str
 
 
+def _polygon_parts(geom: ogr.Geometry) -> ogr.Geometry:
+    """Collect the polygon parts of a geometry collection into a multipolygon
+
+    Args:
+        geom (ogr.Geometry): geometry collection (or any other non-polygon geometry)
+
+    Returns:
+        ogr.Geometry: multipolygon of the polygon parts or None if there aren't any
+    """
+    multi = ogr.Geometry(ogr.wkbMultiPolygon)
+    for i in range(geom.GetGeometryCount()):
+        part = geom.GetGeometryRef(i)
+        part_type = ogr.GT_Flatten(part.GetGeometryType())
+        if part_type == ogr.wkbPolygon:
+            multi.AddGeometry(part)
+        elif part_type == ogr.wkbMultiPolygon:
+            for j in range(part.GetGeometryCount()):
+                multi.AddGeometry(part.GetGeometryRef(j))
+    return multi if multi.GetGeometryCount() > 0 else None
+
+
 def sanitize(name: str, in_path: str, out_path: str, buff_dist: float, select_features=None):
     """
         It's important to make sure we have the right kinds of geometries.
@@ -35,14 +59,10 @@ def sanitize(name: str, in_path: str, out_path: str, buff_dist: float, select_fe
         out_layer_defn = out_lyr.ogr_layer.GetLayerDefn()
         field_count = out_layer_defn.GetFieldCount()
 
-        pts = 0
         square_buff = buff_dist * buff_dist
 
         # NOTE: Order of operations really matters here.
 
-        in_pts = 0
-        out_pts = 0
-
         with GeopackageLayer(tempgpkg.filepath, "sanitize_{}".format(str(uuid4())), write=True, delete_dataset=True) as tmp_lyr, \
                 GeopackageLayer(select_features) as lyr_select_features:
 
@@ -52,65 +72,78 @@ def sanitize(name: str, in_path: str, out_path: str, buff_dist: float, select_fe
                 f_geom = geom_in
                 # Only clean if there's a problem:
                 if not f_geom.IsValid():
-                    f_geom = f_geom.Buffer(0)
-                    if not f_geom.IsValid():
-                        f_geom = f_geom.Buffer(buff_dist)
+                    # MakeValid repairs in a single pass. The buffer out/in round trip is much
+                    # slower on dense polygons so it is only a fallback for what MakeValid can't fix
+                    f_geom = f_geom.MakeValid()
+                    # MakeValid can collapse slivers into lines or points inside a GeometryCollection.
+                    # Only the polygon parts belong in a polygon layer
+                    if f_geom is not None and ogr.GT_Flatten(f_geom.GetGeometryType()) not in [ogr.wkbPolygon, ogr.wkbMultiPolygon]:
+                        f_geom = _polygon_parts(f_geom)
+                    if f_geom is None or not f_geom.IsValid():
+                        f_geom = geom_in.Buffer(buff_dist)
                         f_geom = f_geom.Buffer(-buff_dist)
                 return f_geom
 
+            # The selection features are the same for every candidate so fix them once and index
+            # them, so each candidate is only tested against the selection features it might touch
+            select_geoms = [wkbload(bytes(geom_validity_fix(select_feat.GetGeometryRef().Clone()).ExportToWkb()))
+                            for select_feat, *_ in lyr_select_features.iterate_features()]
+            select_tree = STRtree(select_geoms)
+
             # Only keep features intersected with network
             tmp_lyr.create_layer_from_ref(in_lyr)
 
             for candidate_feat, _c2, _p1 in in_lyr.iterate_features("Finding interesected features", write_layers=[tmp_lyr]):
                 candidate_geom = candidate_feat.GetGeometryRef()
+                # Most candidates are slivers a few cells across. If even the envelope is smaller than
+                # the area threshold below then the shape can never pass it, so don't fix or convert it
+                minx, maxx, miny, maxy = candidate_geom.GetEnvelope()
+                if (maxx - minx) * (maxy - miny) < square_buff:
+                    continue
                 candidate_geom = geom_validity_fix(candidate_geom)
-
-                reach_attributes = {}
-                for n in range(field_count):
-                    field = out_layer_defn.GetFieldDefn(n)
-                    value = candidate_feat.GetField(field.name)
-                    reach_attributes[field.name] = value
-
-                for select_feat, _counter, _progbar in lyr_select_features.iterate_features():
-                    select_geom = select_feat.GetGeometryRef()
-                    select_geom = geom_validity_fix(select_geom)
-                    if select_geom.Intersects(candidate_geom):
-                        feat = ogr.Feature(tmp_lyr.ogr_layer_def)
-                        feat.SetGeometry(candidate_geom)
-                        for field, value in reach_attributes.items():
-                            feat.SetField(field, value)
-                        tmp_lyr.ogr_layer.CreateFeature(feat)
-                        feat = None
-                        break
-
-            # Second loop is about filtering bad areas and simplifying
-            for in_feat, _counter, _progbar in tmp_lyr.iterate_features("Filtering out non-relevant shapes for {}".format(name), write_layers=[out_lyr]):
-
-                reach_attributes = {}
-                for n in range(field_count):
-                    field = out_layer_defn.GetFieldDefn(n)
-                    value = in_feat.GetField(field.name)
-                    reach_attributes[field.name] = value
-
-                fid = in_feat.GetFID()
-                geom = in_feat.GetGeometryRef()
+                candidate_shape = wkbload(bytes(candidate_geom.ExportToWkb()))
+
+                if any(candidate_shape.intersects(select_geom) for select_geom in select_tree.query(candidate_shape)):
+                    feat = ogr.Feature(tmp_lyr.ogr_layer_def)
+                    feat.SetGeometry(candidate_geom)
+                    for n in range(field_count):
+                        field = out_layer_defn.GetFieldDefn(n)
+                        feat.SetField(field.name, candidate_feat.GetField(field.name))
+                    tmp_lyr.ogr_layer.CreateFeature(feat)
+                    feat = None
+
+            def clean_geom(geom):
+                """Fix, filter and simplify one geometry. Returns None if it should be dropped"""
                 geom = geom_validity_fix(geom)
-
-                area = geom.Area()
-                pts += geom.GetBoundary().GetPointCount()
                 # First check. Just make sure this is a valid shape we can work with
                 # Make sure the area is greater than the square of the cell width
-                # Make sure we're not significantly disconnected from the main shape
-                # Make sure we intersect the main shape
-                if geom.IsEmpty() \
-                        or area < square_buff:
-                    # or biggest_area[3].Distance(geom) > 2 * buff_dist:
-                    continue
+                if geom.IsEmpty() or geom.Area() < square_buff:
+                    return None
 
                 f_geom = geom.SimplifyPreserveTopology(buff_dist)
                 # # Only fix things that need fixing
-                f_geom = geom_validity_fix(f_geom)
+                return geom_validity_fix(f_geom)
 
+            # Second loop is about filtering bad areas and simplifying
+            candidates = []
+            for in_feat, _counter, _progbar in tmp_lyr.iterate_features("Reading shapes for {}".format(name)):
+                reach_attributes = {}
+                for n in range(field_count):
+                    field = out_layer_defn.GetFieldDefn(n)
+                    reach_attributes[field.name] = in_feat.GetField(field.name)
+                candidates.append((in_feat.GetFID(), reach_attributes, in_feat.GetGeometryRef().Clone()))
+
+            # Every feature is cleaned independently and OGR releases the GIL while GEOS works,
+            # so the cleaning runs on a thread pool. Writing stays on this thread.
+            with ThreadPoolExecutor() as executor:
+                cleaned = list(executor.map(clean_geom, [geom for _fid, _attrs, geom in candidates]))
+
+            progbar = ProgressBar(len(candidates), 50, "Filtering out non-relevant shapes for {}".format(name))
+            out_lyr.ogr_layer.StartTransaction()
+            for counter, ((fid, reach_attributes, _geom), f_geom) in enumerate(zip(candidates, cleaned)):
+                progbar.update(counter)
+                if f_geom is None:
+                    continue
                 # Second check here for validity after simplification
                 # Then write to a temporary geopackage layer
                 if not f_geom.IsEmpty() and f_geom.Area() > 0:
@@ -121,11 +154,10 @@ def sanitize(name: str, in_path: str, out_path: str, buff_dist: float, select_fe
                         out_feature.SetField(field, value)
 
                     out_lyr.ogr_layer.CreateFeature(out_feature)
-
-                    in_pts += pts
-                    out_pts += f_geom.GetBoundary().GetPointCount()
                 else:
                     log.warning('Invalid GEOM with fid: {} for layer {}'.format(fid, name))
+            out_lyr.ogr_layer.CommitTransaction()
+            progbar.finish()
 
         log.info('Writing to disk for layer {}'.format(name))
 
@@ -6,6 +6,9 @@
 """
 
 from typing import List
+from types import CodeType
+from contextlib import nullcontext
+from math import ceil
 import os
 import shutil
 
@@ -21,8 +24,24 @@ from scipy import ndimage
 from rscommons import ProgressBar, Logger, VectorBase, Timer, TempRaster
 from rscommons.classes.raster import deleteRaster
 
+# Numba is optional. Without it the evidence layers are combined with plain numpy
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 Path = str
 
+# Scratch rasters are written once and read back a few times within the same run. ZSTD at level 1
+# is much cheaper to write and read than DEFLATE at about the same size on disk
+SCRATCH_COMPRESSION = {'compress': 'zstd', 'zstd_level': 1, 'num_threads': 'all_cpus'}
+
+# Channel cells count as this much VBET evidence
+CHANNEL_EVIDENCE_WEIGHT = np.float32(0.995)
+
+# Let GDAL compress GeoTIFF blocks on every core when we create rasters directly through GDAL
+GTIFF_OPTIONS = ["COMPRESS=DEFLATE", "NUM_THREADS=ALL_CPUS"]
+
 
 def get_raster_meta(template_raster: str):
     """Extract the Rasterio meta we need to write a raster from a template raster
@@ -41,6 +60,7 @@ def get_raster_meta(template_raster: str):
         out_meta['driver'] = 'GTiff'
         out_meta['count'] = 1
         out_meta['compress'] = 'deflate'
+        out_meta['num_threads'] = 'all_cpus'
 
     use_big_tiff = os.path.getsize(template_raster) > 3800000000
     if use_big_tiff:
@@ -48,6 +68,191 @@ def get_raster_meta(template_raster: str):
     return out_meta
 
 
+def block_window_count(src: rasterio.DatasetReader) -> int:
+    """Number of windows block_windows(1) yields, without building them all
+
+    Args:
+        src (rasterio.DatasetReader): open raster
+
+    Returns:
+        int: number of native blocks in band 1
+    """
+    block_height, block_width = src.block_shapes[0]
+    return ceil(src.height / block_height) * ceil(src.width / block_width)
+
+
+def nodata_mask(array: np.ndarray, nodata, out: np.ndarray = None) -> np.ndarray:
+    """Boolean mask of the nodata cells of an unmasked raster block
+
+    Same cells rasterio would mask with masked=True, without building a MaskedArray
+
+    Args:
+        array (np.ndarray): block read from a raster
+        nodata: nodata value of the raster (may be None or NaN)
+        out (np.ndarray, optional): boolean array, the shape of array, to write the mask into. Defaults to None.
+
+    Returns:
+        np.ndarray: True where the cell is nodata
+    """
+    if nodata is None:
+        if out is None:
+            return np.zeros(array.shape, dtype=bool)
+        out.fill(False)
+        return out
+    if np.isnan(nodata):
+        return np.isnan(array, out=out)
+    return np.equal(array, nodata, out=out)
+
+
+def iter_chunks(src: rasterio.DatasetReader, chunk_blocks: int = 8, max_bytes: int = 16 * 1024 * 1024):
+    """Yield windows that each cover several of the raster's native blocks
+
+    Reading one native block at a time spends most of its time in per-window overhead.
+    Tiled rasters are read chunk_blocks x chunk_blocks blocks at a time. Striped rasters
+    (one row per block) grow the chunk down the raster until it reaches about max_bytes.
+
+    Args:
+        src (rasterio.DatasetReader): open raster
+        chunk_blocks (int, optional): native blocks per chunk in each direction. Defaults to 8.
+        max_bytes (int, optional): approximate size of one chunk of band 1. Defaults to 16MB.
+
+    Yields:
+        Window: window clipped to the raster bounds
+    """
+    block_height, block_width = src.block_shapes[0]
+    chunk_width = min(src.width, block_width * chunk_blocks)
+    row_bytes = chunk_width * np.dtype(src.dtypes[0]).itemsize * block_height
+    chunk_height = block_height * max(chunk_blocks, max_bytes // row_bytes)
+
+    for row_off in range(0, src.height, chunk_height):
+        for col_off in range(0, src.width, chunk_width):
+            yield Window(col_off, row_off, min(chunk_width, src.width - col_off), min(chunk_height, src.height - row_off))
+
+
+def window_view(buffer: np.ndarray, window: Window) -> np.ndarray:
+    """Contiguous 2D view on the front of a flat scratch buffer, shaped to a window
+
+    Windowed loops allocate their scratch buffers once, sized to the largest window, and
+    reuse them for every window (edge windows included) instead of allocating per window.
+
+    Args:
+        buffer (np.ndarray): flat array at least window.height * window.width long
+        window (Window): window to shape the view to
+
+    Returns:
+        np.ndarray: (height, width) view sharing memory with buffer
+    """
+    return buffer[:window.height * window.width].reshape(window.height, window.width)
+
+
+def transform_evidence_inputs(block: dict, masks: dict, transforms: dict, use_proximity: bool = False,
+                              inv_sqrt_max_prox: float = None, prox_out: np.ndarray = None,
+                              slope_mask_out: np.ndarray = None):
+    """Apply the VBET input transforms to one window of evidence inputs
+
+    Expression transforms (compiled strings) keep the nodata mask of their own input while
+    callable transforms take the HAND mask. When proximity is used the slope is reduced by
+    sqrt(proximity / max proximity) and also picks up the HAND mask, as the masked array
+    subtraction did.
+
+    Args:
+        block (dict): unmasked input arrays for the window, by input name
+        masks (dict): boolean nodata masks for the window, by input name. Must include 'HAND'
+        transforms (dict): transform for each input to apply, by input name
+        use_proximity (bool, optional): weight the slope by proximity. Defaults to False.
+        inv_sqrt_max_prox (float, optional): 1 / sqrt(max proximity). Required with use_proximity.
+        prox_out (np.ndarray, optional): float32 scratch array for the proximity weighting. Defaults to None.
+        slope_mask_out (np.ndarray, optional): boolean scratch array for the slope mask. Defaults to None.
+
+    Returns:
+        (dict, dict): float32 transformed arrays and their nodata masks, by input name
+    """
+    transformed = {}
+    transformed_masks = {}
+    for name, transform in transforms.items():
+        if isinstance(transform, CodeType):
+            trans_ds = eval(transform, {'__builtins__': None}, {'a': block[name]})
+            transformed_masks[name] = masks[name]
+        else:
+            trans_ds = transform(block[name])
+            transformed_masks[name] = masks['HAND']
+        # Expressions on float32 rasters already give a new float32 array, so don't copy it again
+        transformed[name] = np.asarray(trans_ds, dtype=np.float32)
+
+        if name == 'Slope' and use_proximity:
+            prox_weight = np.sqrt(block['Proximity'], out=prox_out, dtype=np.float32)
+            prox_weight *= np.float32(inv_sqrt_max_prox)
+            transformed[name] -= prox_weight
+            transformed_masks[name] = np.logical_or(transformed_masks[name], masks['HAND'], out=slope_mask_out)
+
+    return transformed, transformed_masks
+
+
+def combine_evidence(hand: np.ndarray, slope: np.ndarray, channel: np.ndarray,
+                     hand_mask: np.ndarray, slope_mask: np.ndarray, channel_mask: np.ndarray,
+                     hand_weight: float, slope_weight: float, nodata: float,
+                     topo_out: np.ndarray, evidence_out: np.ndarray):
+    """Combine one window of transformed HAND and slope into topo and VBET evidence
+
+    topo = weighted sum of HAND and slope, evidence = max(topo, 0.995 * channel). Cells that are
+    nodata in any input are set to nodata. Uses a single fused pass when Numba is installed.
+
+    Args:
+        hand (np.ndarray): transformed HAND
+        slope (np.ndarray): transformed slope
+        channel (np.ndarray): rasterized channel
+        hand_mask (np.ndarray): True where HAND is nodata
+        slope_mask (np.ndarray): True where slope is nodata
+        channel_mask (np.ndarray): True where channel is nodata
+        hand_weight (float): HAND weight
+        slope_weight (float): slope weight
+        nodata (float): output nodata value
+        topo_out (np.ndarray): float32 array to receive the topo evidence
+        evidence_out (np.ndarray): float32 array to receive the VBET evidence
+    """
+    # Everything is cast to float32 up front so the Numba and numpy paths do exactly the same arithmetic
+    hand_weight = np.float32(hand_weight)
+    slope_weight = np.float32(slope_weight)
+    nodata = np.float32(nodata)
+
+    combine = _combine_evidence_kernel if _combine_evidence_kernel is not None else _combine_evidence_numpy
+    combine(hand, slope, channel, hand_mask, slope_mask, channel_mask,
+            hand_weight, slope_weight, CHANNEL_EVIDENCE_WEIGHT, nodata, topo_out, evidence_out)
+
+
+def _combine_evidence_numpy(hand, slope, channel, hand_mask, slope_mask, channel_mask,
+                            hand_weight, slope_weight, channel_weight, nodata, topo_out, evidence_out):
+    """numpy version of _combine_evidence_kernel. All scalars must already be float32"""
+    np.multiply(hand, hand_weight, out=topo_out, dtype=np.float32)
+    topo_out += np.multiply(slope, slope_weight, dtype=np.float32)
+    np.maximum(topo_out, np.multiply(channel, channel_weight, dtype=np.float32), out=evidence_out)
+    topo_mask = hand_mask | slope_mask
+    evidence_out[topo_mask | channel_mask] = nodata
+    topo_out[topo_mask] = nodata
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _combine_evidence_kernel(hand, slope, channel, hand_mask, slope_mask, channel_mask,
+                                 hand_weight, slope_weight, channel_weight, nodata, topo_out, evidence_out):
+        for i in prange(hand.shape[0]):
+            for j in range(hand.shape[1]):
+                if hand_mask[i, j] or slope_mask[i, j]:
+                    topo_out[i, j] = nodata
+                    evidence_out[i, j] = nodata
+                    continue
+                topo = np.float32(hand[i, j]) * hand_weight + np.float32(slope[i, j]) * slope_weight
+                topo_out[i, j] = topo
+                if channel_mask[i, j]:
+                    evidence_out[i, j] = nodata
+                else:
+                    chan = np.float32(channel[i, j]) * channel_weight
+                    # Written this way round so a NaN topo stays NaN, like np.maximum
+                    evidence_out[i, j] = chan if chan > topo else topo
+else:
+    _combine_evidence_kernel = None
+
+
 def rasterize(in_lyr_path: Path, out_raster_path: Path, template_path: Path, all_touched: bool = False):
     """Rasterize an input layer
 
@@ -73,25 +278,41 @@ def rasterize(in_lyr_path: Path, out_raster_path: Path, template_path: Path, all
     # Rasterize the features (roads, rail etc) and calculate a raster of Euclidean distance from these features
     progbar.update(0)
 
-    # Rasterize the polygon to a temporary file
-    with TempRaster('vbet_rasterize') as tempfile:
-        log.debug('Temporary file: {}'.format(tempfile.filepath))
-        gdal.Rasterize(
-            tempfile.filepath,
-            ds_path,
-            layers=[lyr_path],
-            xRes=t[0], yRes=t[4],
-            allTouched=all_touched,
-            burnValues=1, outputType=gdal.GDT_Int16,
-            creationOptions=['COMPRESS=LZW'],
-            # outputBounds --- assigned output bounds: [minx, miny, maxx, maxy]
-            outputBounds=[raster_bounds.left, raster_bounds.bottom, raster_bounds.right, raster_bounds.top],
-            callback=poly_progress
-        )
-        progbar.finish()
+    # Rasterize the polygon in memory. It only exists to be masked by the template so writing
+    # it to a temporary GeoTIFF and reading it back again is wasted work
+    mem_ds = gdal.Rasterize(
+        '',
+        ds_path,
+        format='MEM',
+        layers=[lyr_path],
+        xRes=t[0], yRes=t[4],
+        allTouched=all_touched,
+        burnValues=1, outputType=gdal.GDT_Byte,
+        # outputBounds --- assigned output bounds: [minx, miny, maxx, maxy]
+        outputBounds=[raster_bounds.left, raster_bounds.bottom, raster_bounds.right, raster_bounds.top],
+        callback=poly_progress
+    )
+    progbar.finish()
+    mem_band = mem_ds.GetRasterBand(1)
+
+    # Now mask the output correctly
+    with rasterio.open(template_path) as nd_src:
+        out_meta = nd_src.meta
+        out_meta['driver'] = 'GTiff'
+        out_meta['count'] = 1
+        out_meta['dtype'] = rasterio.int16
+        out_meta['nodata'] = -9999
+        out_meta.update(SCRATCH_COMPRESSION)
 
-        # Now mask the output correctly
-        mask_rasters_nodata(tempfile.filepath, template_path, out_raster_path)
+        with rasterio.open(out_raster_path, 'w', **out_meta) as out_src:
+            for window in iter_chunks(nd_src):
+                data = mem_band.ReadAsArray(int(window.col_off), int(window.row_off), int(window.width), int(window.height)).astype(np.int16)
+                data[nodata_mask(nd_src.read(1, window=window), nd_src.nodata)] = out_meta['nodata']
+                out_src.write(data, window=window, indexes=1)
+
+    log.debug('Rasterized {} to {}'.format(in_lyr_path, out_raster_path))
+    mem_band = None
+    mem_ds = None
 
 
 def mask_rasters_nodata(in_raster_path: Path, nodata_raster_path: Path, out_raster_path: Path):
@@ -109,9 +330,9 @@ def mask_rasters_nodata(in_raster_path: Path, nodata_raster_path: Path, out_rast
         # All 3 rasters should have the same extent and properties. They differ only in dtype
         out_meta = data_src.meta
         out_meta['nodata'] = -9999
-        out_meta['compress'] = 'deflate'
+        out_meta.update(SCRATCH_COMPRESSION)
 
-        progbar = ProgressBar(len(list(data_src.block_windows(1))), 50, "Applying nodata mask")
+        progbar = ProgressBar(block_window_count(data_src), 50, "Applying nodata mask")
         with rasterio.open(out_raster_path, 'w', **out_meta) as out_src:
             counter = 0
             # Again, these rasters should be orthogonal so their windows should also line up
@@ -119,10 +340,11 @@ def mask_rasters_nodata(in_raster_path: Path, nodata_raster_path: Path, out_rast
                 progbar.update(counter)
                 counter += 1
                 # These rasterizations don't begin life with a mask.
-                nd_arr = nd_src.read(1, window=window, masked=True)
-                data = data_src.read(1, window=window, masked=True)
-                # Combine the mask of the nd_src with that of the data. This is done in-place
-                data.mask = np.logical_or(nd_arr.mask, data.mask)
+                data = data_src.read(1, window=window)
+                # Combine the mask of the nd_src with that of the data
+                mask = nodata_mask(nd_src.read(1, window=window), nd_src.nodata)
+                mask |= nodata_mask(data, data_src.nodata)
+                data[mask] = out_meta['nodata']
 
                 out_src.write(data, window=window, indexes=1)
 
@@ -220,7 +442,7 @@ def translate(vrtpath_in: Path, raster_out_path: Path, band: int):
     def translate_progress(progress, _msg, _data):
         progbar.update(int(progress * 100))
 
-    translateoptions = gdal.TranslateOptions(gdal.ParseCommandLine("-of Gtiff -b {} -co COMPRESS=DEFLATE".format(band)))
+    translateoptions = gdal.TranslateOptions(gdal.ParseCommandLine("-of Gtiff -b {} -co COMPRESS=DEFLATE -co PREDICTOR=2 -co NUM_THREADS=ALL_CPUS".format(band)))
     gdal.Translate(raster_out_path, vrtpath_in, options=translateoptions, callback=translate_progress)
 
     log.info('completed in {}'.format(tmr.toString()))
@@ -243,7 +465,7 @@ def inverse_mask(nodata_raster_path: Path, out_raster_path: Path):
         out_meta['compress'] = 'deflate'
 
         with rasterio.open(out_raster_path, 'w', **out_meta) as out_src:
-            progbar = ProgressBar(len(list(nd_src.block_windows(1))), 50, "Applying inverse nodata mask")
+            progbar = ProgressBar(block_window_count(nd_src), 50, "Applying inverse nodata mask")
             counter = 0
             # Again, these rasters should be orthogonal so their windows should also line up
             for _ji, window in nd_src.block_windows(1):
@@ -251,10 +473,10 @@ def inverse_mask(nodata_raster_path: Path, out_raster_path: Path):
                 counter += 1
                 # These rasterizations don't begin life with a mask.
                 # TODO: Read mask is quicker?
-                mask = nd_src.read(1, window=window, masked=True).mask
+                mask = nodata_mask(nd_src.read(1, window=window), nd_src.nodata)
 
-                # Fill everywhere the mask reads true with a nodata value
-                mask_vals = np.ma.array(np.full(mask.shape, 1), mask=np.logical_not(mask))
+                # 1 where the input is nodata and nodata everywhere else
+                mask_vals = np.where(mask, 1, out_meta['nodata'])
 
                 out_src.write(mask_vals.astype(out_meta['dtype']), window=window, indexes=1)
 
@@ -291,21 +513,21 @@ def raster_clean(in_raster_path: Path, out_raster_path: Path, buffer_pixels: int
             out_meta['driver'] = 'GTiff'
             out_meta['count'] = 1
             out_meta['compress'] = 'deflate'
+            if out_meta['nodata'] is None:
+                out_meta['nodata'] = 0
 
             with rasterio.open(tmp_buff_out.filepath, 'w', **out_meta) as out_data:
-                progbar = ProgressBar(len(list(out_data.block_windows(1))), 50, "Growing the raster by {} pixels".format(buffer_pixels))
+                progbar = ProgressBar(block_window_count(out_data), 50, "Growing the raster by {} pixels".format(buffer_pixels))
                 counter = 0
                 # Again, these rasters should be orthogonal so their windows should also line up
                 for _ji, window in out_data.block_windows(1):
                     progbar.update(counter)
                     counter += 1
                     prox_out_block = prox_out_src.read(1, window=window)
-                    in_data_block = in_data_src.read(1, window=window, masked=True)
-
-                    new_data = np.full(in_data_block.shape, 1)
-                    new_mask = np.logical_and(in_data_block.mask, prox_out_block > buffer_pixels)
+                    in_data_block = in_data_src.read(1, window=window)
 
-                    output = np.ma.masked_array(new_data, new_mask)
+                    new_mask = nodata_mask(in_data_block, in_data_src.nodata) & (prox_out_block > buffer_pixels)
+                    output = np.where(new_mask, out_meta['nodata'], 1)
 
                     out_data.write(output.astype(out_meta['dtype']), window=window, indexes=1)
 
@@ -320,7 +542,7 @@ def raster_clean(in_raster_path: Path, out_raster_path: Path, buffer_pixels: int
             # Note: we reuse outmeta from before
 
             with rasterio.open(out_raster_path, 'w', **out_meta) as out_data_src:
-                progbar = ProgressBar(len(list(out_data.block_windows(1))), 50, "Shrinking the raster by {} pixels".format(buffer_pixels))
+                progbar = ProgressBar(block_window_count(out_data), 50, "Shrinking the raster by {} pixels".format(buffer_pixels))
                 counter = 0
                 # Again, these rasters should be orthogonal so their windows should also line up
                 for _ji, window in out_data.block_windows(1):
@@ -328,10 +550,7 @@ def raster_clean(in_raster_path: Path, out_raster_path: Path, buffer_pixels: int
                     counter += 1
                     prox_in_block = prox_in_src.read(1, window=window)
 
-                    new_data = np.full(prox_in_block.shape, 1)
-                    new_mask = np.logical_not(prox_in_block > buffer_pixels)
-
-                    output = np.ma.masked_array(new_data, new_mask)
+                    output = np.where(prox_in_block > buffer_pixels, 1, out_meta['nodata'])
                     out_data_src.write(output.astype(out_meta['dtype']), window=window, indexes=1)
 
                 progbar.finish()
@@ -436,6 +655,7 @@ def create_empty_raster(raster_path: Path, template_raster: Path, compress: bool
 
     if compress is True:
         out_meta['compress'] = 'deflate'
+        out_meta['num_threads'] = 'all_cpus'
 
     use_big_tiff = os.path.getsize(template_raster) > 3800000000
     if use_big_tiff:
@@ -443,9 +663,8 @@ def create_empty_raster(raster_path: Path, template_raster: Path, compress: bool
 
     with rasterio.open(raster_path, 'w', **out_meta) as rio_dest:
         for _ji, window in rio_dest.block_windows(1):
-            # Writing a perfectly masked array should give us a raster where everything is nodata
-            # numpy.full(shape, fill_value, dtype=None, order='C', *, like=None)
-            out_arr = np.ma.array(np.full((window.height, window.width), 1), mask=np.full((window.width, window.height), True, bool))
+            # Everything is nodata
+            out_arr = np.full((window.height, window.width), out_meta['nodata'], dtype=out_meta['dtype'])
             rio_dest.write(out_arr, window=window, indexes=1)
     return
 
@@ -463,7 +682,7 @@ def array2raster(newRasterfn: Path, rasterfn: Path, array: np.array, data_type:
     rows = array.shape[0]
 
     driver = gdal.GetDriverByName('GTiff')
-    outRaster = driver.Create(newRasterfn, cols, rows, 1, data_type, options=["COMPRESS=DEFLATE"])
+    outRaster = driver.Create(newRasterfn, cols, rows, 1, data_type, options=GTIFF_OPTIONS)
     outRaster.SetGeoTransform((originX, pixelWidth, 0, originY, 0, pixelHeight))
     outband = outRaster.GetRasterBand(1)
     outband.WriteArray(array)
@@ -497,7 +716,7 @@ def new_raster(newRasterfn: Path, rasterfn: Path, data_type: int = gdal.GDT_Byte
     rows = raster.RasterYSize
 
     driver = gdal.GetDriverByName('GTiff')
-    out_raster = driver.Create(newRasterfn, cols, rows, 1, data_type, options=["COMPRESS=DEFLATE"])
+    out_raster = driver.Create(newRasterfn, cols, rows, 1, data_type, options=GTIFF_OPTIONS)
     out_raster.SetGeoTransform((origin_x, pixel_width, 0, origin_y, 0, pixel_height))
     outband = out_raster.GetRasterBand(1)
 
@@ -527,12 +746,11 @@ def raster_logic_mask(in_raster: Path, out_raster: Path, logic_raster: Path):
 
         for _ji, window in rio_source.block_windows(1):
             array_logic_mask = rio_logic.read(1, window=window)
-            array_source = rio_source.read(1, window=window, masked=True)
+            array_source = rio_source.read(1, window=window)
             # Combine 0 values from the logic raster with the nodata values of the input raster
-            new_mask = np.logical_or(np.logical_not(array_logic_mask), array_source.mask)
-
-            array_out = np.ma.masked_array(array_source, mask=new_mask)
-            rio_dest.write(array_out, window=window, indexes=1)
+            if rio_dest.nodata is not None:
+                array_source[array_logic_mask == 0] = rio_dest.nodata
+            rio_dest.write(array_source, window=window, indexes=1)
 
     return
 
@@ -551,8 +769,7 @@ def raster_recompress(raster_path: Path):
         shutil.copy(raster_path, tempfile.filepath)
         with rasterio.open(tempfile.filepath, 'r') as src, rasterio.open(raster_path, 'w', **meta) as dst:
             for _ji, window in dst.block_windows(1):
-                array_dest = src.read(1, window=window, masked=True)
-                dst.write(array_dest, window=window, indexes=1)
+                dst.write(src.read(1, window=window), window=window, indexes=1)
     log.debug(f'raster_recompress: {_tmr.toString()}')
 
 
@@ -587,22 +804,24 @@ def raster_update_multiply(raster: Path, update_values_raster: Path, value=None)
         for _ji, window in rio_updates.block_windows(1):
             out_window = Window(window.col_off + col_off_delta, window.row_off + row_off_delta, window.width, window.height)
 
-            array_dest = rio_dest.read(1, window=out_window, masked=True)
-            array_update = rio_updates.read(1, window=window, masked=True)
+            array_dest = rio_dest.read(1, window=out_window)
+            array_update = rio_updates.read(1, window=window)
             if array_dest.shape[0] == 0:
                 continue
 
-            if value is not None:
-                array_update = np.multiply(array_update, value)
+            # Only nodata cells of the destination are updated. Nodata and zero cells of
+            # array_update leave array_dest as it is
+            chooser = nodata_mask(array_dest, rio_dest.nodata)
+            chooser &= ~nodata_mask(array_update, rio_updates.nodata)
+            chooser &= array_update != 0
 
-            # we're choosing from two values in an array. 0 = array_dest 1 = array_update
-            chooser = array_dest.mask.astype(int)
-            # Make sure that any nodata values in the array_update default back to array_dest
-            chooser[array_update.mask | array_update == 0] = 0
+            if value is not None:
+                # Multiply in the destination's type. Updates are often byte rasters and the value can be > 255
+                array_update = np.multiply(array_update, value, dtype=array_dest.dtype)
 
-            array_out = np.choose(chooser, [array_dest, array_update])
-            array_out_format = array_out if out_meta['dtype'] == 'int32' else np.float32(array_out)
-            rio_dest.write(array_out_format, window=out_window, indexes=1)
+            # Update the destination block in place rather than building a third array with np.where
+            np.copyto(array_dest, array_update, casting='unsafe', where=chooser)
+            rio_dest.write(array_dest, window=out_window, indexes=1)
     return
 
 
@@ -626,8 +845,10 @@ def raster_remove_zone(raster: Path, remove_raster: Path, output_raster: Path):
             for _ji, window in rio_dest.block_windows(1):
                 array_logic_mask = np.array(rio_remove.read(1, window=window) > 0).astype('int')  # mask of existing data in destination raster
                 array_multiply = np.equal(array_logic_mask, 0).astype('int')
-                array_dest = rio_dest.read(1, window=window, masked=True)
+                array_dest = rio_dest.read(1, window=window)
                 array_out = np.multiply(array_multiply, array_dest)
+                if rio_dest.nodata is not None:
+                    array_out[nodata_mask(array_dest, rio_dest.nodata)] = rio_dest.nodata
                 rio_output.write(array_out, window=window, indexes=1)
     return
 
@@ -704,43 +925,54 @@ def generate_vbet_polygon(vbet_evidence_raster: Path, rasterized_channel: Path,
     """
     log = Logger('VBET Generate Polygon')
     _timer = Timer()
-    # Mask to Hand area
-    vbet_evidence_masked = os.path.join(temp_folder, f"vbet_evidence_masked_{thresh_value}.tif")
-    mask_rasters_nodata(vbet_evidence_raster, channel_hand, vbet_evidence_masked)
-
-    # Threshold Valley Bottom
-    valley_bottom_raw = os.path.join(temp_folder, f"valley_bottom_raw_{thresh_value}.tif")
-    threshold(vbet_evidence_masked, thresh_value, valley_bottom_raw)
+    # Threshold Valley Bottom, masked to the Hand area. This stays in memory since we only
+    # sieve it and read it straight back
+    valley_bottom_raw = threshold_array(vbet_evidence_raster, thresh_value, channel_hand)
 
-    ds_valley_bottom = gdal.Open(valley_bottom_raw, gdal.GA_Update)
+    ds_valley_bottom = gdal.GetDriverByName('MEM').Create('', valley_bottom_raw.shape[1], valley_bottom_raw.shape[0], 1, gdal.GDT_Byte)
     band_valley_bottom = ds_valley_bottom.GetRasterBand(1)
+    band_valley_bottom.SetNoDataValue(0)
+    band_valley_bottom.WriteArray(valley_bottom_raw)
+    valley_bottom_raw = None
 
     log.info('Sieve Filter vbet')
     # Sieve and Clean Raster
     gdal.SieveFilter(srcBand=band_valley_bottom, maskBand=None, dstBand=band_valley_bottom, threshold=10, connectedness=8, callback=gdal.TermProgress_nocb)
-    band_valley_bottom.SetNoDataValue(0)
-    band_valley_bottom.FlushCache()
     valley_bottom_sieved = band_valley_bottom.ReadAsArray()
+    band_valley_bottom = None
+    ds_valley_bottom = None
 
     log.info('Generate regions')
     # Region Tool to find only connected areas
     struct = generate_binary_structure(2, 2)
-    regions, _num = label(valley_bottom_sieved, structure=struct)
+    regions, num_regions = label(valley_bottom_sieved, structure=struct)
     valley_bottom_sieved = None
 
+    # Keep the regions that touch a non-zero channel cell. Flag them in a lookup table indexed by
+    # label rather than multiplying the whole raster and searching it with np.isin
     chan = raster2array(rasterized_channel)
-    selection = regions * chan
+    keep_region = np.zeros(num_regions + 1, dtype=bool)
+    keep_region[regions[chan != 0]] = True
+    keep_region[0] = False
     chan = None
 
-    values = np.unique(selection)
-    non_zero_values = [v for v in values if v != 0]
-    valley_bottom_region = np.isin(regions, non_zero_values)
+    valley_bottom_region = keep_region[regions]
     array2raster(os.path.join(temp_folder, f'regions_{thresh_value}.tif'), vbet_evidence_raster, regions, data_type=gdal.GDT_Int32)
-    array2raster(os.path.join(temp_folder, f'valley_bottom_region_{thresh_value}.tif'), vbet_evidence_raster, valley_bottom_region.astype(int), data_type=gdal.GDT_Int32)
+    array2raster(os.path.join(temp_folder, f'valley_bottom_region_{thresh_value}.tif'), vbet_evidence_raster, valley_bottom_region.astype(np.uint8), data_type=gdal.GDT_Byte)
 
     # Clean Raster Edges
     log.info('Cleaning Raster edges')
-    valley_bottom_clean = binary_closing(valley_bottom_region.astype(int), iterations=2)
+    # binary_closing works on the boolean array directly, no need to widen it to int64 first.
+    # A closing of 2 iterations can't reach more than 2 cells past the region, so only close the
+    # region's bounding box plus that margin rather than the whole level path extent
+    valley_bottom_clean = np.zeros(valley_bottom_region.shape, dtype=bool)
+    rows = np.flatnonzero(valley_bottom_region.any(axis=1))
+    if rows.size > 0:
+        cols = np.flatnonzero(valley_bottom_region.any(axis=0))
+        margin = 2
+        crop = (slice(max(rows[0] - margin, 0), rows[-1] + margin + 1),
+                slice(max(cols[0] - margin, 0), cols[-1] + margin + 1))
+        valley_bottom_clean[crop] = binary_closing(valley_bottom_region[crop], iterations=2)
     donuts = np.invert(valley_bottom_clean)
     donut_regions, num_donuts = label(donuts, struct)
     sizes = ndimage.sum(donuts, donut_regions, range(num_donuts + 1))
@@ -751,7 +983,8 @@ def generate_vbet_polygon(vbet_evidence_raster: Path, rasterized_channel: Path,
         network_array = raster2array(rasterized_flowline)
         final_valley_array = np.maximum(final_valley_array, network_array)
 
-    array2raster(out_valley_bottom, vbet_evidence_raster, final_valley_array, data_type=gdal.GDT_Int32)
+    # Valley bottom is 0/1 so a byte per cell is plenty
+    array2raster(out_valley_bottom, vbet_evidence_raster, final_valley_array.astype(np.uint8), data_type=gdal.GDT_Byte)
 
     log.debug(f'Timer: {_timer.toString()}')
 
@@ -784,54 +1017,120 @@ def generate_centerline_surface(vbet_raster: Path, out_cost_path: Path, temp_fol
     band_proximity.FlushCache()
     proximity = band_proximity.ReadAsArray()
 
-    # Rescale Raster
-    rescaled = np.interp(proximity, (proximity.min(), proximity.max()), (0.0, 10.0))
-    rescaled_raster = os.path.join(temp_folder, 'rescaled.tif')
-    array2raster(rescaled_raster, vbet_raster, rescaled, data_type=gdal.GDT_Float32)
-
-    # Centerline Cost Path
-    cost_path = 10**((rescaled * -1) + 10) + (rescaled <= 0) * 1000000000000  # 10** (((A) * -1) + 10) + (A <= 0) * 1000000000000
+    # Rescale proximity to 0-10 and turn it into the centerline cost path in one buffer:
+    # 10** (((A) * -1) + 10) + (A <= 0) * 1000000000000
+    prox_min = proximity.min()
+    prox_max = proximity.max()
+    if prox_max > prox_min:
+        cost_path = np.subtract(proximity, prox_min, dtype=np.float64)
+        cost_path *= 10.0 / (prox_max - prox_min)
+    else:
+        cost_path = np.full(proximity.shape, 10.0)
+    np.subtract(10.0, cost_path, out=cost_path)
+    np.power(10.0, cost_path, out=cost_path)
+    # A <= 0 only where proximity is at its minimum (a constant raster rescales to 10 everywhere)
+    if prox_max > prox_min:
+        cost_path[proximity == prox_min] += 1000000000000
     array2raster(out_cost_path, vbet_raster, cost_path, data_type=gdal.GDT_Float32)
 
     log.debug(f'Timer: {_timer.toString()}')
 
 
-def threshold(evidence_raster_path: Path, thr_val: float, thresh_raster_path: Path):
+def threshold(evidence_raster_path: Path, thr_val: float, thresh_raster_path: Path, mask_raster_path: Path = None):
     """Threshold a raster to greater than or equal to a threshold value
 
     Args:
         evidence_raster_path (Path): input evidience raster
         thr_val (float): value to threshold
         thresh_raster_path (Path): output threshold raster
+        mask_raster_path (Path, optional): raster of identical size whose nodata cells are excluded. Defaults to None.
     """
     log = Logger('threshold')
     _timer = Timer()
-    with rasterio.open(evidence_raster_path) as fval_src:
+    with rasterio.open(evidence_raster_path) as fval_src, \
+            (rasterio.open(mask_raster_path) if mask_raster_path else nullcontext()) as mask_src:
         out_meta = fval_src.meta
         out_meta['count'] = 1
-        out_meta['compress'] = 'deflate'
+        out_meta.update(SCRATCH_COMPRESSION)
         out_meta['dtype'] = rasterio.uint8
         out_meta['nodata'] = 0
 
         log.info('Thresholding at {}'.format(thr_val))
         with rasterio.open(thresh_raster_path, "w", **out_meta) as dest:
-            progbar = ProgressBar(len(list(fval_src.block_windows(1))), 50, "Thresholding at {}".format(thr_val))
-            counter = 0
-            for _ji, window in fval_src.block_windows(1):
+            windows = list(iter_chunks(fval_src))
+            buffers = threshold_buffers(windows, fval_src, mask_src)
+            progbar = ProgressBar(len(windows), 50, "Thresholding at {}".format(thr_val))
+            for counter, window in enumerate(windows):
                 progbar.update(counter)
-                counter += 1
-                fval_data = fval_src.read(1, window=window, masked=True)
-                # Fill an array with "1" values to give us a nice mask for polygonize
-                fvals_mask = np.full(fval_data.shape, np.uint8(1))
-
-                # Create a raster with 1.0 as a value everywhere in the same shape as fvals
-                new_fval_mask = np.ma.mask_or(fval_data.mask, fval_data < thr_val)
-                masked_arr = np.ma.array(fvals_mask, mask=[new_fval_mask])  # & ch_data.mask])
-                dest.write(np.ma.filled(masked_arr, out_meta['nodata']), window=window, indexes=1)
+                dest.write(threshold_window(fval_src, window, thr_val, mask_src, buffers), window=window, indexes=1)
             progbar.finish()
     log.debug(f'Timer: {_timer.toString()}')
 
 
+def threshold_array(evidence_raster_path: Path, thr_val: float, mask_raster_path: Path = None) -> np.ndarray:
+    """Threshold a raster into an in-memory uint8 array (1 where greater than or equal to the threshold, 0 elsewhere)
+
+    Args:
+        evidence_raster_path (Path): input evidience raster
+        thr_val (float): value to threshold
+        mask_raster_path (Path, optional): raster of identical size whose nodata cells are excluded. Defaults to None.
+
+    Returns:
+        np.ndarray: thresholded array the shape of the evidence raster
+    """
+    with rasterio.open(evidence_raster_path) as fval_src, \
+            (rasterio.open(mask_raster_path) if mask_raster_path else nullcontext()) as mask_src:
+        out = np.zeros(fval_src.shape, dtype=np.uint8)
+        windows = list(iter_chunks(fval_src))
+        buffers = threshold_buffers(windows, fval_src, mask_src)
+        for window in windows:
+            out[window.toslices()] = threshold_window(fval_src, window, thr_val, mask_src, buffers)
+    return out
+
+
+def threshold_buffers(windows: List[Window], fval_src: rasterio.DatasetReader, mask_src: rasterio.DatasetReader = None) -> dict:
+    """Allocate the scratch buffers threshold_window reuses across a set of windows
+
+    Args:
+        windows (List[Window]): windows that will be thresholded
+        fval_src (rasterio.DatasetReader): evidence raster
+        mask_src (rasterio.DatasetReader, optional): mask raster. Defaults to None.
+
+    Returns:
+        dict: flat buffers sized to the largest window
+    """
+    size = max((window.height * window.width for window in windows), default=0)
+    buffers = {'fval': np.empty(size, dtype=fval_src.dtypes[0]), 'out': np.empty(size, dtype=bool)}
+    if mask_src is not None:
+        buffers['mask'] = np.empty(size, dtype=mask_src.dtypes[0])
+    return buffers
+
+
+def threshold_window(fval_src: rasterio.DatasetReader, window: Window, thr_val: float, mask_src: rasterio.DatasetReader = None,
+                     buffers: dict = None) -> np.ndarray:
+    """Threshold one window of an open evidence raster
+
+    Args:
+        fval_src (rasterio.DatasetReader): evidence raster
+        window (Window): window to threshold
+        thr_val (float): value to threshold
+        mask_src (rasterio.DatasetReader, optional): raster whose nodata cells are excluded. Defaults to None.
+        buffers (dict, optional): scratch buffers from threshold_buffers. The result is only valid until the
+            next call with the same buffers. Defaults to None.
+
+    Returns:
+        np.ndarray: uint8 array, 1 where the evidence passes the threshold and 0 (nodata) everywhere else
+    """
+    fval_data = fval_src.read(1, window=window, out=window_view(buffers['fval'], window) if buffers else None)
+    # Compare in the raster's own dtype so float32 evidence isn't promoted to float64
+    out = np.greater_equal(fval_data, fval_data.dtype.type(thr_val), out=window_view(buffers['out'], window) if buffers else None)
+    out &= ~nodata_mask(fval_data, fval_src.nodata)
+    if mask_src is not None:
+        mask_data = mask_src.read(1, window=window, out=window_view(buffers['mask'], window) if buffers else None)
+        out &= ~nodata_mask(mask_data, mask_src.nodata)
+    return out.view(np.uint8)
+
+
 def clean_raster_regions(raster: Path, target_value: int, out_raster: Path, out_regions: Path = None):
     """keep only the largest region of a raster by area
 
@@ -844,30 +1143,26 @@ def clean_raster_regions(raster: Path, target_value: int, out_raster: Path, out_
     log = Logger('Clean Raster Regions')
 
     array = raster2array(raster)
-    if not np.any(array == target_value):
+    target = array == target_value
+    if not np.any(target):
         log.info(f'Raster {raster} does not contain target value of {target_value}. No raster cleaning required.')
         return
 
-    array[array != target_value] = 0  # all values not part of the target value
-    array[array == target_value] = 1
-
     log.info('Generate regions')
     # Region Tool to find only connected areas
     struct = generate_binary_structure(2, 2)
-    regions, _num_labels = label(array, structure=struct)
-    array = None
+    regions, _num_labels = label(target, structure=struct)
 
     size = np.bincount(regions.ravel())
     print(len(size))
     biggest_label = size[1:].argmax() + 1
-    regions[regions != biggest_label] = 0
-    regions[regions == biggest_label] = 1
+    regions = (regions == biggest_label).astype(np.int32)
 
-    array_non_target = raster2array(raster)
-    array_non_target[array_non_target == target_value] = -9999
-    out_array = np.choose(regions, [array_non_target, target_value])
-    array_non_target = None
+    # Target cells outside the biggest region become nodata. Everything else keeps its value,
+    # so the raster only needs reading once and no np.choose copy is made
+    array[target & (regions == 0)] = -9999
+    target = None
 
-    array2raster(out_raster, raster, out_array, data_type=gdal.GDT_Int32, no_data=-9999)
+    array2raster(out_raster, raster, array, data_type=gdal.GDT_Int32, no_data=-9999)
     if out_regions:
         array2raster(out_regions, raster, regions, data_type=gdal.GDT_Int32)